@@ -0,0 +1,406 @@
+"""
+Offline benchmarks for platforms.py: a synthetic gtfs feed and stands, a mock BMTC-API serving them, and scripted
+scenarios run against both. Nothing here touches the live API or needs a real gtfs feed.
+
+    python3 benchmark.py [scenario...] [--stands=14] [--routes=200] [--nest-level=15] [--latency=0.01]
+                         [--failure-rate=0.05] [--coverage=0.9] [--rate=1000] [--workdir=bench] [--output=path]
+
+Scenarios are cold, warm, resume, stages and batch (all of them by default). The feed has --stands stands
+(--stands=1 for a single stand, 14 is about the size of the city), cold, warm, resume and stages use the first
+one and batch all of them. Each run is a separate platforms.py process, its throughput and latency come from the
+run's --metrics summary and its peak RSS from wait4().
+"""
+import csv
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import timeit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import platforms
+
+PLATFORMS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'platforms.py')
+SCENARIOS = ('cold', 'warm', 'resume', 'stages', 'batch')
+CITY_STANDS = 14  # Stands in stands.json
+
+# Synthetic feed configuration
+GRID_ORIGIN = (12.85, 77.45)  # South-west corner of the stop grid
+GRID_STEP_DEGREES = 0.004
+STOPS_PER_STAND = 400  # The grid grows with the number of stands
+STAND_STOPS = 4  # Stop ids per stand
+STAND_PLATFORMS = 7
+PATTERN_STOPS = (20, 40)  # Length range of a route after its stand
+TRIPS_PER_ROUTE = 3
+
+
+def generate_gtfs(workdir, stands=1, routes_per_stand=200, seed=1):
+    """
+    Write a synthetic city into workdir: a gtfs feed in workdir/gtfs/ with routes walking a grid of stops away
+    from each stand, plus the stands.json, in/ geojsons, overrides.json and stops-platforms.json platforms.py
+    expects next to it. Returns the stands manifest.
+    """
+    rng = random.Random(seed)
+    side = math.ceil(math.sqrt(stands * STOPS_PER_STAND))
+    stop_ids = [[str(10000 + row * side + col) for col in range(side)] for row in range(side)]
+    gtfs = os.path.join(workdir, 'gtfs')
+    os.makedirs(gtfs, exist_ok=True)
+    with open(os.path.join(gtfs, 'stops.txt'), 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['stop_id', 'stop_name', 'stop_lat', 'stop_lon'])
+        for row in range(side):
+            for col in range(side):
+                writer.writerow([stop_ids[row][col], f'Stop {row}-{col}', GRID_ORIGIN[0] + row * GRID_STEP_DEGREES,
+                                 GRID_ORIGIN[1] + col * GRID_STEP_DEGREES])
+
+    def walk(row, col, length):
+        cells = []
+        for _ in range(length):
+            row = min(side - 1, max(0, row + rng.choice((-1, 0, 1))))
+            col = min(side - 1, max(0, col + rng.choice((-1, 0, 1))))
+            cells.append((row, col))
+        return cells
+
+    manifest = {}
+    os.makedirs(os.path.join(workdir, 'in'), exist_ok=True)
+    route_id = 1000
+    with open(os.path.join(gtfs, 'trips.txt'), 'w', newline='') as trips_file, \
+            open(os.path.join(gtfs, 'stop_times.txt'), 'w', newline='') as times_file:
+        trips = csv.writer(trips_file)
+        trips.writerow(['route_id', 'service_id', 'trip_id'])
+        times = csv.writer(times_file)
+        times.writerow(['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'])
+        for stand in range(stands):
+            row, col = rng.randrange(side), rng.randrange(side)
+            stand_cells = [(row, col)] + walk(row, col, STAND_STOPS - 1)
+            name = f'stand{stand + 1}'
+            manifest[name] = {'stop_ids': [stop_ids[r][c] for r, c in stand_cells], 'nest_level': 15}
+            write_stand_geojson(workdir, name, GRID_ORIGIN[0] + row * GRID_STEP_DEGREES,
+                                GRID_ORIGIN[1] + col * GRID_STEP_DEGREES)
+            for _ in range(routes_per_stand):
+                route_id += 1
+                start = rng.choice(stand_cells)
+                cells = [start] + walk(*start, rng.randint(*PATTERN_STOPS))
+                if rng.random() < 0.3:  # Some routes only pass through the stand
+                    cells = walk(*start, rng.randint(1, 5))[::-1] + cells
+                pattern = list(dict.fromkeys(stop_ids[r][c] for r, c in cells))
+                for trip in range(TRIPS_PER_ROUTE):
+                    trip_id = f'{route_id}_{trip}'
+                    trips.writerow([route_id, 'weekday', trip_id])
+                    for sequence, stop in enumerate(pattern):
+                        clock = f'{6 + trip:02d}:{sequence % 60:02d}:00'
+                        times.writerow([trip_id, clock, clock, stop, sequence + 1])
+
+    with open(os.path.join(workdir, 'stands.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    for name in ('overrides.json', 'stops-platforms.json'):
+        with open(os.path.join(workdir, name), 'w') as file:
+            file.write('{}')
+    for name in ('raw', 'out', 'help'):
+        os.makedirs(os.path.join(workdir, name), exist_ok=True)
+    return manifest
+
+
+def write_stand_geojson(workdir, name, lat, lon):
+    features = [{
+        'type': 'Feature',
+        'properties': {'Platform': str(platform)},
+        'geometry': {'type': 'Point', 'coordinates': [lon + platform * 0.0001, lat]},
+    } for platform in range(1, STAND_PLATFORMS + 1)]
+    with open(os.path.join(workdir, 'in', f'platforms-{name}.geojson'), 'w') as file:
+        json.dump({'type': 'FeatureCollection', 'features': features}, file, indent=2)
+
+
+class MockBmtcApi:
+    """
+    GetAllRouteList and GetTimetableByStation_v4 answered from a gtfs feed, on a local port. A pair gets every
+    route running from one stop to the other. latency is added to every response, failure_rate of them are
+    HTTP 503 and only a coverage fraction of routes report a platform.
+    """
+
+    def __init__(self, gtfs, latency=0.0, failure_rate=0.0, coverage=1.0, seed=1):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.lock = threading.Lock()
+        first_trips = {}  # Trip -> route, for the first trip of every route
+        with open(os.path.join(gtfs, 'trips.txt'), newline='') as file:
+            seen = set()
+            for row in csv.DictReader(file):
+                if row['route_id'] not in seen:
+                    seen.add(row['route_id'])
+                    first_trips[row['trip_id']] = row['route_id']
+        patterns = {route: [] for route in first_trips.values()}
+        with open(os.path.join(gtfs, 'stop_times.txt'), newline='') as file:
+            for row in csv.DictReader(file):
+                if row['trip_id'] in first_trips:
+                    patterns[first_trips[row['trip_id']]].append(row['stop_id'])
+        self.positions = {}  # Route -> stop -> first position
+        self.calls = {}  # Stop -> routes calling at it
+        for route, stops in patterns.items():
+            positions = self.positions[route] = {}
+            for pos, stop in enumerate(stops):
+                positions.setdefault(stop, pos)
+                self.calls.setdefault(stop, set()).add(route)
+        self.platforms = {route: str(self.rng.randrange(STAND_PLATFORMS) + 1) if self.rng.random() < coverage else ''
+                          for route in sorted(patterns)}
+        self.server = None
+
+    def route_list(self):
+        return {'Issuccess': True, 'data': [{
+            'routeid': int(route), 'routeno': f'{route} UP', 'fromstation': 'Origin', 'fromstationid': 1,
+            'tostation': f'Destination {route}', 'tostationid': 2,
+        } for route in self.platforms]}
+
+    def timetable(self, from_stop, to_stop):
+        routes = sorted(route for route in self.calls.get(from_stop, ())
+                        if self.positions[route].get(to_stop, -1) > self.positions[route][from_stop])
+        if not routes:
+            return {'Issuccess': False, 'isException': False, 'exception': None, 'Message': 'No Records Found',
+                    'data': None}
+        return {'Issuccess': True, 'isException': False, 'exception': None, 'data': [{
+            'routeid': int(route), 'routeno': route, 'routename': f'R-{route}', 'fromstationid': int(from_stop),
+            'platformname': self.platforms[route], 'platformnumber': self.platforms[route],
+            'baynumber': int(route) % 3 or None,
+        } for route in routes]}
+
+    def start(self, port=0):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                    if not self.path.endswith('GetAllRouteList'):
+                        stops = str(body['fromStationId']), str(body['toStationId'])
+                except (ValueError, KeyError, TypeError):  # Cut short, e.g. by the resume scenario killing its client
+                    self.send_response(400)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                with api.lock:
+                    api.requests += 1
+                    fail = api.rng.random() < api.failure_rate
+                time.sleep(api.latency)
+                if fail:
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if self.path.endswith('GetAllRouteList'):
+                    answer = api.route_list()
+                else:
+                    answer = api.timetable(*stops)
+                data = json.dumps(answer).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                if not isinstance(sys.exc_info()[1], ConnectionError):  # The resume scenario kills its client
+                    super().handle_error(request, client_address)
+
+        self.server = Server(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_address[1]}/WebAPI/'
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def journal_records(path):
+    """Answered requests in a platforms.py run journal"""
+    try:
+        with open(path) as file:
+            return sum(1 for line in file if line.startswith('{"request":'))
+    except FileNotFoundError:
+        return 0
+
+
+class Bench:
+    """Runs platforms.py in workdir against a MockBmtcApi and collects one result per scenario"""
+
+    def __init__(self, workdir, api, api_url, rate):
+        self.workdir = workdir
+        self.api = api
+        self.env = {**os.environ, 'BMTC_API_URL': api_url, 'BMTC_API_RATE': str(rate),
+                    'BMTC_GTFS_FOLDER': os.path.join(workdir, 'gtfs'), 'BMTC_LOG_LEVEL': 'WARNING'}
+        self.results = {}
+
+    def reset(self, cache=True):
+        """Forget the previous runs' results, and the response cache unless cache is False"""
+        names = ['raw', 'out', 'help', platforms.BUILD_MANIFEST_PATH, platforms.ROUTE_CATALOGUE_PATH]
+        if cache:
+            names.append(platforms.CACHE_DB_PATH)
+        for name in names:
+            path = os.path.join(self.workdir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+                os.makedirs(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def run(self, scenario, args, kill_after=None, journal=None):
+        """
+        Run platforms.py with args, or kill it once kill_after answered requests are in its journal. Returns the run's
+        metrics summary (None if it was killed) with its peak RSS and exit status added.
+        """
+        metrics_path = os.path.join(self.workdir, f'metrics-{scenario}.json')
+        requests_before = self.api.requests
+        process = subprocess.Popen([sys.executable, PLATFORMS_SCRIPT, *args, f'--metrics={metrics_path}'],
+                                   cwd=self.workdir, env=self.env, stdout=subprocess.DEVNULL)
+        if kill_after is not None:
+            while process.poll() is None and journal_records(journal) < kill_after:
+                time.sleep(0.01)
+            if process.poll() is not None:
+                raise RuntimeError(f'{scenario}: the run finished before {kill_after} requests were journaled')
+            process.kill()
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if kill_after is not None:
+            return None
+        with open(metrics_path) as file:
+            summary = json.load(file)
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        summary['peak_rss_mb'] = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        summary['exit_status'] = process.returncode
+        summary['api_requests'] = self.api.requests - requests_before
+        return summary
+
+    def record(self, scenario, summary, extra=None):
+        counters = summary['counters']
+        fetch_seconds = summary['stages'].get('fetch', 0)
+        latency = summary['histograms'].get('api.latency.GetTimetableByStation_v4', {})
+        self.results[scenario] = {
+            'wall_seconds': summary['wall_seconds'],
+            'stages': summary['stages'],
+            'pairs': counters.get('search.requested', 0),
+            'api_requests': summary['api_requests'],
+            'pairs_per_second': counters.get('search.requested', 0) / fetch_seconds if fetch_seconds else None,
+            'latency_p50_ms': latency['p50'] * 1000 if latency else None,
+            'latency_p99_ms': latency['p99'] * 1000 if latency else None,
+            'cache_hits': counters.get('cache.hit', 0) + counters.get('cache.stale', 0),
+            'cache_misses': counters.get('cache.miss', 0),
+            'peak_rss_mb': summary['peak_rss_mb'],
+            'exit_status': summary['exit_status'],
+            **(extra or {}),
+        }
+
+    def stand_args(self, manifest, name):
+        return [*manifest[name]['stop_ids'], name, str(manifest[name]['nest_level'])]
+
+    def cold(self, manifest, name):
+        self.reset()
+        self.record('cold', self.run('cold', self.stand_args(manifest, name)))
+
+    def warm(self, manifest, name):
+        self.reset(cache=False)
+        self.record('warm', self.run('warm', self.stand_args(manifest, name)))
+
+    def resume(self, manifest, name):
+        """Kill a cold run half way through, then time the --resume run that finishes it"""
+        self.reset()
+        expected = self.results.get('cold', {}).get('api_requests') or 200
+        journal = os.path.join(self.workdir, 'raw', f'platforms-{name}.journal.jsonl')
+        self.run('resume', self.stand_args(manifest, name), kill_after=max(expected // 2, 1), journal=journal)
+        journaled = journal_records(journal)
+        if not journaled:
+            raise RuntimeError('resume: the killed run journaled nothing, its resume would be a cold run')
+        summary = self.run('resume', [*self.stand_args(manifest, name), '--resume'])
+        self.record('resume', summary, {'journaled_records': journaled})
+
+    def stages(self, manifest, name):
+        """In-process timings of get_next_stops and add_routes_gtfs_geojson, the fetch needs to have run"""
+        if not os.path.exists(os.path.join(self.workdir, 'out', f'platforms-routes-{name}.geojson')):
+            self.reset(cache=False)
+            self.run('stages', self.stand_args(manifest, name))
+        cwd = os.getcwd()
+        os.chdir(self.workdir)
+        try:
+            platforms.gtfs_folder = self.env['BMTC_GTFS_FOLDER'] + os.sep
+            stop_ids, nest_level = manifest[name]['stop_ids'], manifest[name]['nest_level']
+            platforms.load_gtfs_graph()
+            with open(os.path.join('out', f'platforms-routes-{name}.geojson')) as file:
+                geojson_json = json.load(file)
+            timings = {}
+            for label, function in (
+                    ('get_next_stops', lambda: platforms.get_next_stops(stop_ids, nest_level)),
+                    ('geo_json', lambda: platforms.geo_json(stop_ids, name, write_output=False)),
+                    ('add_routes_gtfs_geojson', lambda: platforms.add_routes_gtfs_geojson(stop_ids, name, geojson_json))):
+                runs, seconds = timeit.Timer(function).autorange()
+                timings[f'{label}_ms'] = seconds / runs * 1000
+        finally:
+            os.chdir(cwd)
+        self.results['stages'] = timings
+
+    def batch(self, manifest):
+        self.reset()
+        summary = self.run('batch', ['all', 'stands.json', '--force'])
+        self.record('batch', summary, {'stands': len(manifest)})
+
+
+def main(argv):
+    args, flags = platforms.split_flags(argv)
+    scenarios = args or list(SCENARIOS)
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if unknown:
+        print(f'Unknown scenarios {unknown}, choose from {list(SCENARIOS)}')
+        return 2
+    workdir = os.path.abspath(flags.get('workdir', 'bench'))
+    stands = int(flags.get('stands', CITY_STANDS))
+    routes = int(flags.get('routes', 200))
+    output = flags.get('output', os.path.join(workdir, 'benchmark-results.json'))
+
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    print(f'generating {stands} stands with {routes} routes each in {workdir}')
+    manifest = generate_gtfs(workdir, stands, routes)
+    for stand in manifest.values():
+        stand['nest_level'] = int(flags.get('nest-level', stand['nest_level']))
+    with open(os.path.join(workdir, 'stands.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    api = MockBmtcApi(os.path.join(workdir, 'gtfs'), float(flags.get('latency', 0.01)),
+                      float(flags.get('failure-rate', 0.05)), float(flags.get('coverage', 0.9)))
+    bench = Bench(workdir, api, api.start(), int(flags.get('rate', 1000)))
+    first = next(iter(manifest))
+    try:
+        for scenario in SCENARIOS:
+            if scenario not in scenarios:
+                continue
+            print(f'running {scenario}')
+            if scenario == 'batch':
+                bench.batch(manifest)
+            else:
+                getattr(bench, scenario)(manifest, first)
+    finally:
+        api.stop()
+
+    for scenario, result in bench.results.items():
+        print(f'{scenario}: ' + ', '.join(f'{key} {value:.2f}' if isinstance(value, float) else f'{key} {value}'
+                                          for key, value in result.items() if key != 'stages'))
+    with open(output, 'w') as file:
+        json.dump({'flags': flags, 'results': bench.results}, file, indent=2)
+    print(f'wrote {output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
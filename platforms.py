@@ -1,114 +1,348 @@
+import asyncio
+import atexit
+import collections
+import contextlib
+import copy
+import cProfile
 import csv
 import datetime
+import gzip
 import json
+import logging
 import os
+import pstats
+import random
+import re
 import time
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
 import threading
+import queue
 import sqlite3
 import hashlib
+import itertools
+import math
+import mmap
+import struct
+import zlib
+from array import array
 
 import requests
 
+try:
+    import aiohttp
+except ImportError:  # Optional, falls back to a pooled requests.Session
+    aiohttp = None
+try:
+    import numpy
+except ImportError:  # Optional, nearest platforms are then found one stop at a time
+    numpy = None
+
+log = logging.getLogger('platforms')
+
+# Metrics configuration
+METRICS_PATH = 'run-metrics.json'
+PROFILE_PATH = 'platforms.prof'
+
+
+class Metrics:
+    """
+    Process wide counters, histograms and stage wall times, safe to update from any thread. Counter and
+    histogram names are dotted, e.g. `cache.hit` or `search.failed.level.3`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.histograms = {}  # Name -> every observed value
+        self.stages = collections.Counter()  # Name -> wall seconds during which it was running
+        self.active = collections.Counter()  # Name -> blocks of the stage running right now
+        self.busy_since = {}  # Name -> start of the current period with the stage running
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms.setdefault(name, array('d')).append(value)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Add the wall time of the block to a stage, also usable as a decorator of a synchronous function. Blocks of
+        one stage running at the same time (e.g. the searches of concurrent stands) are only counted once.
+        """
+        with self.lock:
+            if not self.active[name]:
+                self.busy_since[name] = time.perf_counter()
+            self.active[name] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active[name] -= 1
+                if not self.active[name]:
+                    self.stages[name] += time.perf_counter() - self.busy_since.pop(name)
+
+    @staticmethod
+    def describe(values):
+        ordered = sorted(values)
+
+        def percentile(fraction):
+            return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+        return {'count': len(ordered), 'sum': sum(ordered), 'min': ordered[0], 'p50': percentile(0.5),
+                'p90': percentile(0.9), 'p99': percentile(0.99), 'max': ordered[-1]}
+
+    def summary(self):
+        with self.lock:
+            now = time.perf_counter()
+            stages = collections.Counter(self.stages)
+            for name, since in self.busy_since.items():
+                stages[name] += now - since
+            return {
+                'argv': sys.argv,
+                'started': self.started,
+                'wall_seconds': time.time() - self.started,
+                'stages': dict(stages),
+                'counters': dict(sorted(self.counters.items())),
+                'histograms': {name: self.describe(values) for name, values in sorted(self.histograms.items()) if values},
+            }
+
+    def write(self, path=METRICS_PATH):
+        summary = self.summary()
+        write_json(path, summary)
+        log.info('wrote run metrics to %s (%.1fs, stages: %s)', path, summary['wall_seconds'],
+                 ', '.join(f'{name} {seconds:.2f}s' for name, seconds in summary['stages'].items()))
+
+
+metrics = Metrics()
+
 # Cache configuration
 CACHE_DB_PATH = 'api_cache.db'
-CACHE_DURATION_HOURS = 24
+CACHE_DURATION_HOURS = 24  # Responses younger than this are served as is
+CACHE_STALE_DAYS = 30  # Older responses are served while a fresh copy is fetched in the background
+CACHE_MAX_BYTES = 256 * 1024 * 1024  # Compressed payload size at which least recently used entries are evicted
+CACHE_TOUCH_SECONDS = 3600  # Granularity of the last access time used for LRU eviction
+CACHE_WRITE_BATCH = 200  # Most writes committed in one transaction
+CACHE_FLUSH_SECONDS = 0.5  # Longest a stored response waits for its batch to fill up
+
+class ResponseCache:
+    """
+    SQLite cache of API responses, shared by every stand process.
+
+    Entries are keyed on the normalized (endpoint, from, to) request and hold zlib compressed JSON. Lookups go
+    through one long-lived connection. Stores and access time updates are queued and a background writer thread
+    commits them in batches (stores are served from memory until then), evicting the least recently used
+    entries whenever the cache grows past CACHE_MAX_BYTES. The database runs in WAL mode so stand processes keep
+    reading while another one commits.
+    """
+
+    def __init__(self, path=CACHE_DB_PATH, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = self.connect()
+        self.conn_lock = threading.Lock()
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'api_cache'").fetchone():
+            log.warning('dropping the response cache in the old api_cache table of %s, it will be fetched again', path)
+        self.conn.executescript('''
+            BEGIN IMMEDIATE;
+            DROP TABLE IF EXISTS api_cache;
+            CREATE TABLE IF NOT EXISTS api_responses (
+                cache_key TEXT PRIMARY KEY,
+                response BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS api_responses_created_at ON api_responses (created_at);
+            CREATE INDEX IF NOT EXISTS api_responses_accessed_at ON api_responses (accessed_at);
+            -- Running total of the compressed sizes, so eviction does not have to sum the whole table
+            CREATE TABLE IF NOT EXISTS api_responses_size (total INTEGER NOT NULL);
+            INSERT INTO api_responses_size SELECT COALESCE(SUM(size), 0) FROM api_responses
+                WHERE NOT EXISTS (SELECT 1 FROM api_responses_size);
+            CREATE TRIGGER IF NOT EXISTS api_responses_inserted AFTER INSERT ON api_responses
+                BEGIN UPDATE api_responses_size SET total = total + new.size; END;
+            CREATE TRIGGER IF NOT EXISTS api_responses_updated AFTER UPDATE OF size ON api_responses
+                BEGIN UPDATE api_responses_size SET total = total + new.size - old.size; END;
+            CREATE TRIGGER IF NOT EXISTS api_responses_deleted AFTER DELETE ON api_responses
+                BEGIN UPDATE api_responses_size SET total = total - old.size; END;
+            COMMIT;
+        ''')
+        self.pending = {}  # Cache key -> (compressed response, created_at) not committed yet
+        self.pending_lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, name='cache-writer', daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # A crash can lose the last batches, never corrupt the file
+        return conn
+
+    def get(self, cache_key, max_age):
+        """(response json, created_at) for an entry younger than max_age seconds, None otherwise"""
+        now = time.time()
+        with self.pending_lock:
+            row = self.pending.get(cache_key)
+        if row is None:
+            with self.conn_lock:
+                result = self.conn.execute('''
+                    SELECT response, created_at, accessed_at FROM api_responses
+                    WHERE cache_key = ? AND created_at > ?
+                ''', (cache_key, now - max_age)).fetchone()
+            if result is None:
+                return None
+            row = result[:2]
+            if now - result[2] > CACHE_TOUCH_SECONDS:
+                self.queue.put(('touch', cache_key, now))
+        return zlib.decompress(row[0]).decode(), row[1]
+
+    def put(self, cache_key, response_data):
+        now = time.time()
+        payload = zlib.compress(response_data.encode())
+        with self.pending_lock:
+            self.pending[cache_key] = (payload, now)
+        self.queue.put(('store', cache_key, payload, now))
+
+    def write_loop(self):
+        conn = self.connect()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + CACHE_FLUSH_SECONDS
+            while len(batch) < CACHE_WRITE_BATCH and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:  # Sentinel from close()
+                running = False
+            stores = [op for op in batch if op is not None and op[0] == 'store']
+            touches = [op for op in batch if op is not None and op[0] == 'touch']
+            try:
+                with conn:
+                    conn.executemany('''
+                        INSERT INTO api_responses (cache_key, response, size, created_at, accessed_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (cache_key) DO UPDATE SET response = excluded.response, size = excluded.size,
+                            created_at = excluded.created_at, accessed_at = excluded.accessed_at
+                    ''', [(key, payload, len(payload), now, now) for _, key, payload, now in stores])
+                    conn.executemany('UPDATE api_responses SET accessed_at = ? WHERE cache_key = ?',
+                                     [(now, key) for _, key, now in touches])
+                    if stores:
+                        self.evict(conn)
+            except sqlite3.Error as e:
+                log.error('cache store error: %s', e)
+                metrics.count('cache.store_error', len(stores))
+            with self.pending_lock:
+                for _, key, payload, _ in stores:
+                    if self.pending.get(key, (None,))[0] is payload:
+                        del self.pending[key]
+            for _ in batch:
+                self.queue.task_done()
+        conn.close()
+
+    def evict(self, conn):
+        """Delete least recently used entries until the cache is back under 90% of its size limit"""
+        total = conn.execute('SELECT total FROM api_responses_size').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - int(self.max_bytes * 0.9)
+        evicted = []
+        for key, size in conn.execute('SELECT cache_key, size FROM api_responses ORDER BY accessed_at'):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany('DELETE FROM api_responses WHERE cache_key = ?', evicted)
+        log.info('evicted %d least recently used cache entries', len(evicted))
+        metrics.count('cache.evicted', len(evicted))
+
+    def flush(self):
+        """Wait until every queued write is committed"""
+        self.queue.join()
+
+    def cleanup_expired(self, max_age):
+        with self.conn_lock, self.conn:
+            return self.conn.execute('DELETE FROM api_responses WHERE created_at <= ?',
+                                     (time.time() - max_age,)).rowcount
+
+    def stats(self):
+        """(entries, compressed bytes)"""
+        self.flush()
+        with self.conn_lock:
+            return self.conn.execute(
+                'SELECT (SELECT COUNT(*) FROM api_responses), total FROM api_responses_size').fetchone()
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        self.conn.close()
+
+_response_cache = None
 
 def init_cache_db():
-    """Initialize the SQLite cache database"""
-    conn = sqlite3.connect(CACHE_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS api_cache (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            request_hash TEXT UNIQUE NOT NULL,
-            from_stop TEXT NOT NULL,
-            to_stop TEXT NOT NULL,
-            request_data TEXT NOT NULL,
-            response_data TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-def get_cache_key(from_stop, to_stop, request_data):
-    """Generate a unique cache key for the request"""
-    # Create a hash of the request parameters
-    request_string = "{}:{}:{}".format(from_stop, to_stop, request_data)
-    return hashlib.md5(request_string.encode()).hexdigest()
-
-def get_cached_response(from_stop, to_stop, request_data):
-    """Get cached response if it exists and is not expired"""
+    """Open the process wide response cache, creating the database if needed"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache(CACHE_DB_PATH)
+        atexit.register(close_cache_db)  # Do not lose queued stores if a run ends early
+    return _response_cache
+
+def close_cache_db():
+    """Commit outstanding stores and close the response cache"""
+    global _response_cache
+    if _response_cache is not None:
+        _response_cache.close()
+        _response_cache = None
+
+def get_cache_key(from_stop, to_stop, endpoint='GetTimetableByStation_v4'):
+    """Cache key of a request, only the parts of the request that decide the answer go into it"""
+    return '{}:{}:{}'.format(endpoint, int(from_stop), int(to_stop))
+
+def get_cached_response(from_stop, to_stop, endpoint='GetTimetableByStation_v4'):
+    """
+    Get a cached response and whether it is stale (older than CACHE_DURATION_HOURS, so it should be refreshed).
+    Returns (None, False) when there is nothing usable.
+    """
     try:
-        conn = sqlite3.connect(CACHE_DB_PATH)
-        cursor = conn.cursor()
-        
-        cache_key = get_cache_key(from_stop, to_stop, request_data)
-        
-        # Get response if it exists and is not older than CACHE_DURATION_HOURS
-        cursor.execute('''
-            SELECT response_data FROM api_cache 
-            WHERE request_hash = ? 
-            AND created_at > datetime('now', '-%d hours')
-        ''' % CACHE_DURATION_HOURS, (cache_key,))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
+        result = init_cache_db().get(get_cache_key(from_stop, to_stop, endpoint), CACHE_STALE_DAYS * 86400)
         if result:
-            print('        cache hit: {} -> {}'.format(from_stop, to_stop))
-            return json.loads(result[0])
+            stale = time.time() - result[1] > CACHE_DURATION_HOURS * 3600
+            log.debug('cache hit%s: %s -> %s', ' (stale)' if stale else '', from_stop, to_stop)
+            metrics.count('cache.stale' if stale else 'cache.hit')
+            return json.loads(result[0]), stale
         else:
-            print('        cache miss: {} -> {}'.format(from_stop, to_stop))
-            return None
+            log.debug('cache miss: %s -> %s', from_stop, to_stop)
+            metrics.count('cache.miss')
+            return None, False
             
     except Exception as e:
-        print('        cache error: {}'.format(e))
-        return None
+        log.error('cache error: %s', e)
+        metrics.count('cache.error')
+        return None, False
 
-def store_cached_response(from_stop, to_stop, request_data, response_data):
-    """Store response in cache"""
-    try:
-        conn = sqlite3.connect(CACHE_DB_PATH)
-        cursor = conn.cursor()
-        
-        cache_key = get_cache_key(from_stop, to_stop, request_data)
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO api_cache 
-            (request_hash, from_stop, to_stop, request_data, response_data, created_at)
-            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (cache_key, from_stop, to_stop, request_data, json.dumps(response_data)))
-        
-        conn.commit()
-        conn.close()
-        print('        cached: {} -> {}'.format(from_stop, to_stop))
-        
-    except Exception as e:
-        print('        cache store error: {}'.format(e))
+def store_cached_response(from_stop, to_stop, response_data, endpoint='GetTimetableByStation_v4'):
+    """Queue a response to be stored in the cache"""
+    cache_key = get_cache_key(from_stop, to_stop, endpoint)
+    init_cache_db().put(cache_key, json.dumps(response_data, separators=(',', ':')))
+    log.debug('cached: %s -> %s', from_stop, to_stop)
+    metrics.count('cache.store')
 
 def cleanup_expired_cache():
-    """Remove expired cache entries"""
+    """Remove entries too old to be served even while refreshing"""
     try:
-        conn = sqlite3.connect(CACHE_DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            DELETE FROM api_cache 
-            WHERE created_at <= datetime('now', '-%d hours')
-        ''' % CACHE_DURATION_HOURS)
-        
-        deleted_count = cursor.rowcount
-        conn.commit()
-        conn.close()
-        
+        deleted_count = init_cache_db().cleanup_expired(CACHE_STALE_DAYS * 86400)
         if deleted_count > 0:
-            print('Cleaned up {} expired cache entries'.format(deleted_count))
+            log.info('cleaned up %d expired cache entries', deleted_count)
             
     except Exception as e:
-        print('Cache cleanup error: {}'.format(e))
+        log.error('cache cleanup error: %s', e)
 
 request_headers = {
     'Accept': 'application/json, text/plain, */*',
@@ -119,130 +353,1042 @@ request_headers = {
     'Origin': 'https://bmtcwebportal.amnex.com',
     'Referer': 'https://bmtcwebportal.amnex.com/'
 }
-api_url = 'https://bmtcmobileapi.karnataka.gov.in/WebAPI/'
+api_url = os.environ.get('BMTC_API_URL', 'https://bmtcmobileapi.karnataka.gov.in/WebAPI/')  # Point at a mock server
 
-gtfs_folder = '../bmtc-19-07-2024/'  # This gtfs folder is our source for stops, as opposed to querying api
+# API client configuration
+API_CONCURRENCY = int(os.environ.get('BMTC_API_CONCURRENCY', 16))  # Requests in flight at once
+API_RATE_PER_SECOND = float(os.environ.get('BMTC_API_RATE', 40))  # Token bucket refill rate
+API_BURST = 10  # Token bucket size
+API_MAX_RETRIES = 4
+API_BACKOFF_SECONDS = 0.5  # Base of the exponential backoff between retries
+API_TIMEOUT_SECONDS = 30
 
 
-def get_next_stops(stop_ids, nest_level=5):
-    print('starting get_next_stops')
-    # Load GTFS files
-    # with open(f"{gtfs_folder}trips.txt", mode='r') as file:
-    #     reader = csv.DictReader(file)
-    #     trips_list = list(reader)
-    #     trips = {x['trip_id']: x for x in trips_list}
-    with open(f"{gtfs_folder}stop_times.txt", mode='r') as file:
-        reader = csv.DictReader(file)
-        stop_times = list(reader)
-    # with open(f"{gtfs_folder}stops.txt", mode='r') as file:
-    #     reader = csv.DictReader(file)
-    #     stops = {row["stop_id"]: row["stop_name"] for row in reader}
-
-    next_stops_total = {stop_id: [] for stop_id in stop_ids}
-
-    # Group stop_times by trip_id for faster access
-    stop_times_by_trip = {}
-    for st in stop_times:
-        stop_times_by_trip.setdefault(st['trip_id'], []).append(st)
-
-    # Sort stop_times within each trip by stop_sequence
-    for trip_id in stop_times_by_trip:
-        stop_times_by_trip[trip_id].sort(key=lambda x: int(x['stop_sequence']))
-
-
-    for stop_id in stop_ids:
-        for st in stop_times:
-            if st['stop_id'] != stop_id:
+class ApiError(Exception):
+    """The API could not give an answer for a request"""
+
+
+class TransientApiError(ApiError):
+    """Connection problems, timeouts, throttling, server errors and non-JSON bodies, worth retrying"""
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:  # Waiters are served in order
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FairShareLimiter:
+    """
+    Caps requests in flight at `limit`, splitting the slots equally between the shares (stands) that currently
+    have requests waiting or in flight, so a large stand cannot starve the others.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.total = 0
+        self.in_flight = collections.Counter()
+        self.waiting = collections.Counter()
+        self.condition = asyncio.Condition()
+
+    def fair_share(self):
+        active = len(self.in_flight + self.waiting)  # Counter addition drops the zero counts
+        return max(1, -(-self.limit // active))
+
+    @contextlib.asynccontextmanager
+    async def slot(self, share=None):
+        async with self.condition:
+            self.waiting[share] += 1
+            try:
+                await self.condition.wait_for(
+                    lambda: self.total < self.limit and self.in_flight[share] < self.fair_share())
+            finally:
+                self.waiting[share] -= 1
+            self.in_flight[share] += 1
+            self.total += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight[share] -= 1
+                self.total -= 1
+                self.condition.notify_all()
+
+
+class RequestsTransport:
+    """requests.Session on a thread pool, keeping one keep-alive connection per worker thread"""
+
+    def __init__(self, concurrency):
+        self.session = requests.Session()
+        self.session.headers.update(request_headers)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def _post(self, url, body):
+        try:
+            response = self.session.post(url, data=body, timeout=API_TIMEOUT_SECONDS)
+        except requests.RequestException as e:
+            raise TransientApiError(str(e)) from e
+        return response.status_code, response.text
+
+    async def post(self, url, body):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._post, url, body)
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+class AiohttpTransport:
+    """Native asyncio transport, used when aiohttp is installed"""
+
+    def __init__(self, concurrency):
+        self.session = aiohttp.ClientSession(
+            headers=request_headers,
+            connector=aiohttp.TCPConnector(limit=concurrency),
+            timeout=aiohttp.ClientTimeout(total=API_TIMEOUT_SECONDS)
+        )
+
+    async def post(self, url, body):
+        try:
+            async with self.session.post(url, data=body) as response:
+                return response.status, await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TransientApiError(str(e) or type(e).__name__) from e
+
+    async def close(self):
+        await self.session.close()
+
+
+def default_transport(concurrency):
+    return AiohttpTransport(concurrency) if aiohttp is not None else RequestsTransport(concurrency)
+
+
+class ApiClient:
+    """
+    Async client for the BMTC API. Requests share pooled keep-alive connections, are capped at `concurrency`
+    in flight (shared fairly between the `share` keys callers pass), paced by a token bucket, and transient
+    failures are retried with jittered exponential backoff. Identical requests made while one is in flight
+    wait for its answer instead of being sent again. A well-formed JSON answer is always returned as is,
+    including "no route" answers.
+    """
+
+    def __init__(self, base_url=None, transport=None, concurrency=API_CONCURRENCY, rate=API_RATE_PER_SECOND,
+                 max_retries=API_MAX_RETRIES):
+        self.base_url = base_url or api_url
+        self.transport = transport
+        self.concurrency = concurrency
+        self.limiter = FairShareLimiter(concurrency)
+        self.in_flight = {}  # (endpoint, body) -> task
+        self.bucket = TokenBucket(rate, API_BURST)
+        self.max_retries = max_retries
+
+    async def __aenter__(self):
+        if self.transport is None:
+            self.transport = default_transport(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.transport.close()
+
+    async def post_json(self, endpoint, body, share=None):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        key = (endpoint, body)
+        if key not in self.in_flight:
+            self.in_flight[key] = asyncio.ensure_future(self.send(endpoint, body, share))
+            self.in_flight[key].add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(self.in_flight[key])
+
+    async def send(self, endpoint, body, share):
+        for attempt in range(self.max_retries + 1):
+            async with self.limiter.slot(share):
+                await self.bucket.acquire()
+                try:
+                    start = time.perf_counter()
+                    try:
+                        status, text = await self.transport.post(f'{self.base_url}{endpoint}', body)
+                    finally:
+                        metrics.observe(f'api.latency.{endpoint}', time.perf_counter() - start)
+                    metrics.count(f'api.status.{status}')
+                    if status == 429 or status >= 500:
+                        raise TransientApiError(f'{endpoint} returned HTTP {status}')
+                    if status >= 400:
+                        raise ApiError(f'{endpoint} returned HTTP {status}')
+                    try:
+                        return json.loads(text)
+                    except ValueError:
+                        raise TransientApiError('Response not received in JSON.')
+                except TransientApiError as e:
+                    if attempt == self.max_retries:
+                        metrics.count('api.gave_up')
+                        raise
+                    log.debug('retrying %s after: %s', endpoint, e)
+                    metrics.count('api.retry')
+            # Full jitter, so throttled workers do not retry in lockstep
+            await asyncio.sleep(random.uniform(0, API_BACKOFF_SECONDS * 2 ** attempt))
+
+# This gtfs folder is our source for stops, as opposed to querying api
+gtfs_folder = os.path.join(os.environ.get('BMTC_GTFS_FOLDER', '../bmtc-19-07-2024'), '')
+
+
+# Compiled GTFS snapshots, keyed by the content hash of the feed
+GTFS_CACHE_DIR = 'gtfs_cache'
+GTFS_FEED_FILES = ('stops.txt', 'trips.txt', 'stop_times.txt')
+GTFS_SNAPSHOT_MAGIC = b'BMTCGTFS'
+GTFS_SNAPSHOT_VERSION = 3
+NO_INDEX = 0xFFFFFFFF
+
+
+class GtfsGraph:
+    """
+    Compact, array-backed view of the stops and trip patterns in a GTFS feed.
+
+    Stop, trip and route ids are interned to integers (stops and trips in stops.txt / trips.txt order).
+    Trips are stored CSR-style: the stops of trip `t` are `trip_stops[trip_offsets[t]:trip_offsets[t + 1]]`
+    in stop_sequence order. The reverse index stores, for every stop `s`, the (trip, position) pairs at which
+    it is first visited by each trip, in `occ_trips` / `occ_pos` between `occ_offsets[s]` and
+    `occ_offsets[s + 1]`.
+
+    Every route is also represented by the stop pattern of its first trip in trips.txt order, stored the same
+    way in `pattern_offsets` / `pattern_stops`, with its own stop -> (route, position) index in `pat_occ_*`.
+
+    The integer arrays are either `array.array`s (freshly compiled) or read-only memoryviews over a
+    memory-mapped snapshot, both support the same indexing and slicing.
+    """
+
+    ARRAYS = {
+        'stop_lat': 'd', 'stop_lon': 'd', 'trip_route': 'I', 'trip_offsets': 'I', 'trip_stops': 'I',
+        'occ_offsets': 'I', 'occ_trips': 'I', 'occ_pos': 'I', 'pattern_offsets': 'I', 'pattern_stops': 'I',
+        'pat_occ_offsets': 'I', 'pat_occ_routes': 'I', 'pat_occ_pos': 'I',
+    }
+    STRINGS = ('stop_ids', 'stop_names', 'route_ids')
+
+    def __init__(self, stop_ids, stop_names, route_ids, stop_lat, stop_lon, trip_route, trip_offsets, trip_stops,
+                 occ_offsets, occ_trips, occ_pos, pattern_offsets, pattern_stops, pat_occ_offsets, pat_occ_routes,
+                 pat_occ_pos):
+        self.stop_ids = stop_ids
+        self.stop_index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+        self.stop_names = stop_names
+        self.route_ids = route_ids
+        self.route_index = {route_id: i for i, route_id in enumerate(route_ids)}
+        self.stop_lat = stop_lat
+        self.stop_lon = stop_lon
+        self.trip_route = trip_route
+        self.trip_offsets = trip_offsets
+        self.trip_stops = trip_stops
+        self.occ_offsets = occ_offsets
+        self.occ_trips = occ_trips
+        self.occ_pos = occ_pos
+        self.pattern_offsets = pattern_offsets
+        self.pattern_stops = pattern_stops
+        self.pat_occ_offsets = pat_occ_offsets
+        self.pat_occ_routes = pat_occ_routes
+        self.pat_occ_pos = pat_occ_pos
+        self.pattern_names = {}  # Route -> stop names of its pattern, built on first use and shared by every stand
+
+    @classmethod
+    def from_folder(cls, folder):
+        """Compile the graph from the CSV files of a GTFS folder"""
+        stop_index = {}
+        stop_names = []
+        stop_lat = array('d')
+        stop_lon = array('d')
+        with open(os.path.join(folder, 'stops.txt'), mode='r', newline='') as file:
+            for row in csv.DictReader(file):
+                if row['stop_id'] in stop_index:
+                    continue  # Keep the first of duplicated stop_ids, so the columns stay aligned with the index
+                stop_index[row['stop_id']] = len(stop_index)
+                stop_names.append(row['stop_name'])
+                stop_lat.append(float(row['stop_lat']))
+                stop_lon.append(float(row['stop_lon']))
+
+        trip_index = {}
+        route_index = {}
+        trip_route = array('I')
+        with open(os.path.join(folder, 'trips.txt'), mode='r', newline='') as file:
+            for row in csv.DictReader(file):
+                if row['trip_id'] in trip_index:
+                    continue  # Keep the first of duplicated trip_ids, so trip_route stays aligned with the index
+                trip_index[row['trip_id']] = len(trip_index)
+                trip_route.append(route_index.setdefault(row['route_id'], len(route_index)))
+
+        row_trip = array('I')
+        row_stop = array('I')
+        row_seq = array('I')
+        with open(os.path.join(folder, 'stop_times.txt'), mode='r', newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            trip_col = header.index('trip_id')
+            stop_col = header.index('stop_id')
+            seq_col = header.index('stop_sequence')
+            for row in reader:
+                row_trip.append(trip_index.setdefault(row[trip_col], len(trip_index)))
+                row_stop.append(stop_index.setdefault(row[stop_col], len(stop_index)))
+                row_seq.append(int(row[seq_col]))
+        # Stops and trips only referenced from stop_times.txt
+        stop_names.extend([''] * (len(stop_index) - len(stop_names)))
+        stop_lat.extend([math.nan] * (len(stop_index) - len(stop_lat)))
+        stop_lon.extend([math.nan] * (len(stop_index) - len(stop_lon)))
+        trip_route.extend([NO_INDEX] * (len(trip_index) - len(trip_route)))
+
+        # Counting sort of the rows by trip, keeping file order within a trip
+        trip_offsets = array('I', bytes(4 * (len(trip_index) + 1)))
+        for trip in row_trip:
+            trip_offsets[trip + 1] += 1
+        for t in range(len(trip_index)):
+            trip_offsets[t + 1] += trip_offsets[t]
+        cursor = array('I', trip_offsets[:-1])
+        trip_stops = array('I', bytes(4 * len(row_trip)))
+        trip_seqs = array('I', bytes(4 * len(row_trip)))
+        for trip, stop, seq in zip(row_trip, row_stop, row_seq):
+            trip_stops[cursor[trip]] = stop
+            trip_seqs[cursor[trip]] = seq
+            cursor[trip] += 1
+        del row_trip, row_stop, row_seq, cursor
+
+        # Feeds are normally already ordered by stop_sequence, only sort the trips that are not
+        for t in range(len(trip_index)):
+            start, end = trip_offsets[t], trip_offsets[t + 1]
+            seqs = trip_seqs[start:end]
+            if any(seqs[i] > seqs[i + 1] for i in range(len(seqs) - 1)):
+                ordered = sorted(range(start, end), key=trip_seqs.__getitem__)
+                trip_stops[start:end] = array('I', (trip_stops[i] for i in ordered))
+        del trip_seqs
+
+        stop_ids = [None] * len(stop_index)
+        for stop_id, i in stop_index.items():
+            stop_ids[i] = stop_id
+        route_ids = [None] * len(route_index)
+        for route_id, i in route_index.items():
+            route_ids[i] = route_id
+        pattern_offsets, pattern_stops = cls.build_patterns(len(route_ids), trip_route, trip_offsets, trip_stops)
+        return cls(stop_ids, stop_names, route_ids, stop_lat, stop_lon, trip_route, trip_offsets, trip_stops,
+                   *cls.build_occurrences(len(stop_ids), trip_offsets, trip_stops), pattern_offsets, pattern_stops,
+                   *cls.build_occurrences(len(stop_ids), pattern_offsets, pattern_stops))
+
+    @staticmethod
+    def build_patterns(route_count, trip_route, trip_offsets, trip_stops):
+        """The stops of the first trip of every route (in trips.txt order), CSR-style by route"""
+        first = [NO_INDEX] * route_count
+        for trip, route in enumerate(trip_route):
+            if route != NO_INDEX and first[route] == NO_INDEX:
+                first[route] = trip
+        pattern_offsets = array('I', [0])
+        pattern_stops = array('I')
+        for trip in first:
+            if trip != NO_INDEX:
+                pattern_stops.extend(trip_stops[trip_offsets[trip]:trip_offsets[trip + 1]])
+            pattern_offsets.append(len(pattern_stops))
+        return pattern_offsets, pattern_stops
+
+    @staticmethod
+    def build_occurrences(stop_count, trip_offsets, trip_stops):
+        """
+        Build the stop -> (trip, position) index, keeping only the first visit of a stop by each trip. Also used
+        for the route patterns, where the "trips" are routes.
+        """
+        def first_visits():
+            for t in range(len(trip_offsets) - 1):
+                start, end = trip_offsets[t], trip_offsets[t + 1]
+                seen = set()
+                for pos in range(end - start):
+                    stop = trip_stops[start + pos]
+                    if stop not in seen:
+                        seen.add(stop)
+                        yield stop, t, pos
+
+        occ_offsets = array('I', bytes(4 * (stop_count + 1)))
+        for stop, _, _ in first_visits():
+            occ_offsets[stop + 1] += 1
+        for s in range(stop_count):
+            occ_offsets[s + 1] += occ_offsets[s]
+        cursor = array('I', occ_offsets[:-1])
+        occ_trips = array('I', bytes(4 * occ_offsets[-1]))
+        occ_pos = array('I', bytes(4 * occ_offsets[-1]))
+        for stop, t, pos in first_visits():
+            occ_trips[cursor[stop]] = t
+            occ_pos[cursor[stop]] = pos
+            cursor[stop] += 1
+        return occ_offsets, occ_trips, occ_pos
+
+    def save(self, path):
+        """
+        Write the graph as a snapshot: magic, version, header length, a JSON header holding the string tables
+        and the array layout, then every array 8-byte aligned in native byte order.
+        """
+        layout = {}
+        offset = 0
+        for name, typecode in self.ARRAYS.items():
+            values = getattr(self, name)
+            layout[name] = [typecode, offset, len(values)]
+            offset += -(-len(values) * array(typecode).itemsize // 8) * 8
+        header = json.dumps({
+            'byteorder': sys.byteorder,
+            'arrays': layout,
+            **{name: getattr(self, name) for name in self.STRINGS}
+        }, separators=(',', ':')).encode()
+        header += b' ' * (-(len(GTFS_SNAPSHOT_MAGIC) + 8 + len(header)) % 8)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(GTFS_SNAPSHOT_MAGIC)
+            file.write(struct.pack('<II', GTFS_SNAPSHOT_VERSION, len(header)))
+            file.write(header)
+            for name, typecode in self.ARRAYS.items():
+                data = array(typecode, getattr(self, name)).tobytes()
+                file.write(data)
+                file.write(b'\0' * (-len(data) % 8))
+        os.replace(tmp_path, path)  # Readers never see a partially written snapshot
+
+    @classmethod
+    def load(cls, path):
+        """Map a snapshot written by save() read-only, the arrays are shared with every other process mapping it"""
+        with open(path, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(GTFS_SNAPSHOT_MAGIC)] != GTFS_SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not a GTFS snapshot')
+        start = len(GTFS_SNAPSHOT_MAGIC)
+        version, header_length = struct.unpack('<II', mapped[start:start + 8])
+        if version != GTFS_SNAPSHOT_VERSION:
+            raise ValueError(f'{path} is snapshot version {version}, expected {GTFS_SNAPSHOT_VERSION}')
+        start += 8
+        header = json.loads(mapped[start:start + header_length])
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was written on a {header["byteorder"]}-endian machine')
+        start += header_length
+        view = memoryview(mapped)
+        arrays = {}
+        for name, (typecode, offset, count) in header['arrays'].items():
+            size = array(typecode).itemsize
+            arrays[name] = view[start + offset:start + offset + count * size].cast(typecode)
+        return cls(*(header[name] for name in cls.STRINGS), *(arrays[name] for name in cls.ARRAYS))
+
+    def stop_location(self, stop_id):
+        """[lat, lon] of a stop, None if the stop is not in stops.txt"""
+        stop = self.stop_index.get(stop_id)
+        if stop is None or math.isnan(self.stop_lat[stop]):
+            return None
+        return [self.stop_lat[stop], self.stop_lon[stop]]
+
+    def pattern_starts(self, stop_ids):
+        """Route -> first position at which its pattern calls at any of stop_ids"""
+        starts = {}
+        for stop_id in stop_ids:
+            stop = self.stop_index.get(stop_id)
+            if stop is None:
                 continue
+            for i in range(self.pat_occ_offsets[stop], self.pat_occ_offsets[stop + 1]):
+                route, pos = self.pat_occ_routes[i], self.pat_occ_pos[i]
+                if pos < starts.get(route, NO_INDEX):
+                    starts[route] = pos
+        return starts
 
-            trip_id = st['trip_id']
-            trip_stop_times = stop_times_by_trip[trip_id]
+    def route_stop_names(self, route_id, starts=None):
+        """
+        Stop names of a route's pattern, from the first stop in starts (see pattern_starts) onward. The full
+        pattern is returned as the shared list itself and must not be modified.
+        """
+        route = self.route_index.get(route_id)
+        if route is None:
+            return []
+        names = self.pattern_names.get(route)
+        if names is None:
+            names = self.pattern_names[route] = [
+                self.stop_names[stop]
+                for stop in self.pattern_stops[self.pattern_offsets[route]:self.pattern_offsets[route + 1]]]
+        start = starts.get(route, 0) if starts else 0
+        return names[start:] if start else names
 
-            # Find index of current stop
-            current_index = next(
-                (i for i, x in enumerate(trip_stop_times) if x['stop_id'] == stop_id), None)
+    def occurrences(self, stop_id):
+        """Yield (trip, position) for every trip that calls at stop_id"""
+        stop = self.stop_index.get(stop_id)
+        if stop is None:
+            return
+        for i in range(self.occ_offsets[stop], self.occ_offsets[stop + 1]):
+            yield self.occ_trips[i], self.occ_pos[i]
 
-            if current_index is None:
+    def downstream_routes(self, origin, nest_level):
+        """Stop id -> route ids of the trips calling at that stop within nest_level stops after origin"""
+        downstream = {}
+        for trip, pos in self.occurrences(origin):
+            route = self.trip_route[trip]
+            if route == NO_INDEX:
                 continue
+            start = self.trip_offsets[trip] + pos
+            for stop in self.trip_stops[start + 1:min(start + nest_level + 1, self.trip_offsets[trip + 1])]:
+                downstream.setdefault(self.stop_ids[stop], set()).add(self.route_ids[route])
+        return downstream
 
-            # Traverse up to `n` next stops from this stop along this trip
-            for offset in range(nest_level):
-                idx = current_index + offset
-                if idx >= len(trip_stop_times) - 1:
-                    break
+    def next_stops(self, stop_ids, nest_level=5):
+        """
+        For every trip calling at one of stop_ids, walk up to nest_level hops onward and collect the
+        stop -> next stop edges that were traversed. Runs in time proportional to the edges visited.
+        """
+        next_stops_total = {stop_id: [] for stop_id in stop_ids}
+        seen = {}
+        trip_offsets, trip_stops, stop_names = self.trip_offsets, self.trip_stops, self.stop_ids
+        for stop_id in stop_ids:
+            for trip, pos in self.occurrences(stop_id):
+                start = trip_offsets[trip] + pos
+                end = min(start + nest_level, trip_offsets[trip + 1] - 1)
+                for idx in range(start, end):
+                    curr, nxt = trip_stops[idx], trip_stops[idx + 1]
+                    edges = seen.get(curr)
+                    if edges is None:
+                        edges = seen[curr] = set()
+                        next_stops_total.setdefault(stop_names[curr], [])
+                    if nxt not in edges:
+                        edges.add(nxt)
+                        next_stops_total[stop_names[curr]].append(stop_names[nxt])
+        return next_stops_total
+
+
+def gtfs_feed_hash(folder=None):
+    """
+    Content hash of the GTFS files a snapshot is compiled from. Hashes are remembered per
+    (path, size, mtime) in the snapshot directory so an unchanged feed is not re-read on every run.
+    """
+    folder = folder or gtfs_folder
+    index_path = os.path.join(GTFS_CACHE_DIR, 'feeds.json')
+    try:
+        with open(index_path, 'r') as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        index = {}
+    stats = []
+    for name in GTFS_FEED_FILES:
+        stat = os.stat(os.path.join(folder, name))
+        stats.append([stat.st_size, stat.st_mtime_ns])
+    key = os.path.abspath(folder)
+    if key in index and index[key]['stats'] == stats:
+        return index[key]['hash']
+
+    digest = hashlib.sha256()
+    for name in GTFS_FEED_FILES:
+        digest.update(name.encode())
+        with open(os.path.join(folder, name), 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+    feed_hash = digest.hexdigest()
+    index[key] = {'stats': stats, 'hash': feed_hash}
+    os.makedirs(GTFS_CACHE_DIR, exist_ok=True)
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(index, file, indent=2)
+    os.replace(tmp_path, index_path)
+    return feed_hash
 
-                curr = trip_stop_times[idx]['stop_id']
-                nxt = trip_stop_times[idx + 1]['stop_id']
 
-                if curr not in next_stops_total:
-                    next_stops_total[curr] = []
+def gtfs_snapshot_path(folder=None):
+    return os.path.join(GTFS_CACHE_DIR, f'gtfs-{gtfs_feed_hash(folder)[:16]}-v{GTFS_SNAPSHOT_VERSION}.bin')
 
-                if nxt not in next_stops_total[curr]:
-                    next_stops_total[curr].append(nxt)
-    print('finished get_next_stops')
+
+def compile_gtfs_snapshot(folder=None):
+    """Compile the feed into its snapshot unless an up to date one already exists, returns the snapshot path"""
+    folder = folder or gtfs_folder
+    path = gtfs_snapshot_path(folder)
+    if not os.path.exists(path):
+        log.info('compiling gtfs snapshot %s from %s', path, folder)
+        os.makedirs(GTFS_CACHE_DIR, exist_ok=True)
+        GtfsGraph.from_folder(folder).save(path)
+    return path
+
+
+_gtfs_graphs = {}
+
+
+def load_gtfs_graph(folder=None):
+    """Map the feed's snapshot (compiling it on first use) once per process"""
+    folder = os.path.join(folder or gtfs_folder, '')
+    if folder not in _gtfs_graphs:
+        with metrics.stage('gtfs_load'):
+            _gtfs_graphs[folder] = GtfsGraph.load(compile_gtfs_snapshot(folder))
+    return _gtfs_graphs[folder]
+
+
+def write_json(path, data, indent=2):
+    """
+    Write data to a json file, replaced atomically so readers never see half an artifact. Indented files are
+    streamed chunk by chunk, json has no C encoder for them either way. Minified ones are encoded in one go, as
+    iterencode would give up the C encoder.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        if indent is None:
+            file.write(json.dumps(data, separators=(',', ':')))
+        else:
+            for chunk in json.JSONEncoder(indent=indent).iterencode(data):
+                file.write(chunk)
+    os.replace(tmp_path, path)
+
+
+def split_flags(argv):
+    """Separate `--flag[=value]` options from positional arguments, flags given without a value are True"""
+    flags = {}
+    args = []
+    for arg in argv:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            flags[name] = value or True
+        else:
+            args.append(arg)
+    return args, flags
+
+
+def parse_stand_args(argv=None):
+    """Split `<stop_id>... <stand> [nest_level] [--flag[=value]]...` into (stop_ids, stand, nest_level, flags)"""
+    args, flags = split_flags(sys.argv[1:] if argv is None else argv)
+    if args[-1].isdigit():  # Check if the last argument is a number
+        return args[:-2], args[-2], int(args[-1]), flags
+    return args[:-1], args[-1], 2, flags  # Default nest_level if none is provided
+
+
+def get_next_stops(stop_ids, nest_level=5):
+    with metrics.stage('next_stops'):
+        next_stops_total = load_gtfs_graph().next_stops(stop_ids, nest_level=nest_level)
 
     return next_stops_total
 
 
-def save_platforms():
-    print('starting save_platforms')
+class PlatformSearch:
+    """
+    Discovery of the platforms serving a stand by querying (origin, stop) pairs along the trips leaving each
+    origin stop. A pair that gets no answer is expanded to the stops after it, up to nest_level hops from the
+    origin. Each pair is requested at most once and a failed pair's next hop is queued as soon as it fails instead
+    of after the rest of its level. A pair is always explored from the shallowest level it is reached at, so a
+    pair first reached through a longer chain is expanded again when a shorter one arrives, and the pairs
+    searched do not depend on which answers came back first.
+
+    With a `score` function pairs are requested highest score first. A pair scoring 0 is neither requested nor
+    expanded, and stop() drops everything still queued. Pairs in `completed` (pair ->
+    whether it failed, from a resumed run) are not requested again, failed ones are expanded right away.
+    """
+
+    def __init__(self, origins, next_stops, nest_level, send_request, on_result, score=None, completed=None):
+        self.next_stops = next_stops
+        self.nest_level = nest_level
+        self.send_request = send_request  # async (origin, stop) -> (from_stop, to_stop, response, is_failed)
+        self.on_result = on_result  # (from_stop, to_stop, response, is_failed, level)
+        self.score = score  # (origin, stop) -> how much requesting the pair is expected to reveal
+        self.completed = completed or {}
+        self.queue = asyncio.PriorityQueue()
+        self.seen = {}  # (origin, stop) -> shallowest level it was queued at
+        self.done = {}  # (origin, stop) -> whether it failed, None while its request is in flight
+        self.order = itertools.count()  # FIFO among equal priorities
+        self.stopped = False
+        self.requested = 0
+        self.skipped = 0
+        for origin in origins:
+            self.expand(origin, origin, 0)
+
+    def priority(self, origin, stop, level):
+        return (-self.score(origin, stop) if self.score else 0), level, next(self.order)
+
+    def stop(self):
+        self.stopped = True
+
+    def expand(self, origin, stop, level):
+        """Queue the pairs for the stops following `stop`, which are `level` hops away from origin"""
+        if level >= self.nest_level:
+            return
+        for next_stop in self.next_stops.get(stop, []):
+            if level < self.seen.get((origin, next_stop), self.nest_level):
+                self.seen[(origin, next_stop)] = level
+                metrics.count(f'search.frontier.level.{level}')
+                self.queue.put_nowait((self.priority(origin, next_stop, level), origin, next_stop, level))
+
+    async def worker(self):
+        while True:
+            priority, origin, stop, level = await self.queue.get()
+            try:
+                if self.stopped or level > self.seen[(origin, stop)]:
+                    continue  # Stopped, or a shallower path to the pair has been queued since
+                if (origin, stop) in self.done:
+                    # Reached again by a shorter path, its answer is known (or will be, see below)
+                    if self.done[(origin, stop)]:
+                        self.expand(origin, stop, level + 1)
+                    continue
+                if (origin, stop) in self.completed:
+                    if self.completed[(origin, stop)]:
+                        self.expand(origin, stop, level + 1)
+                    continue
+                if self.score:
+                    # Scores only drop as routes get covered, requeue pairs that lost their place
+                    current = self.priority(origin, stop, level)
+                    if current[0] == 0:
+                        # Nothing left to reveal here, nor further along the trips through it
+                        self.skipped += 1
+                        metrics.count('search.pruned')
+                        continue
+                    if current[0] > priority[0]:
+                        self.queue.put_nowait((current, origin, stop, level))
+                        continue
+                self.requested += 1
+                self.done[(origin, stop)] = None
+                from_stop, to_stop, response, is_failed = await self.send_request(origin, stop)
+                self.done[(origin, stop)] = is_failed
+                self.on_result(from_stop, to_stop, response, is_failed, level)
+                if is_failed:
+                    # From the shallowest level reached while the request was in flight
+                    self.expand(origin, stop, self.seen[(origin, stop)] + 1)
+            finally:
+                self.queue.task_done()
+
+    async def run(self, workers):
+        tasks = [asyncio.ensure_future(self.worker()) for _ in range(workers)]
+        drained = asyncio.ensure_future(self.queue.join())
+        try:
+            await asyncio.wait([drained, *tasks], return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                if task.done():
+                    task.result()  # A worker only stops by raising, surface its error
+        finally:
+            for task in [drained, *tasks]:
+                task.cancel()
+            await asyncio.gather(drained, *tasks, return_exceptions=True)
+
+
+class RunJournal:
+    """
+    Append-only JSON lines record of a save_platforms run, so a killed run can be resumed. The first line
+    describes the run, then every completed request ({"request": [from, to], "level", "failed"}) is appended
+    right after the entries it received ({"received": entry}).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def replay(self):
+        """Yield the records of an earlier run, a line cut short by a crash ends the replay"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+
+    def open(self, header, resume=False):
+        """Start a new journal, or keep appending to the earlier one if it was written for the same run"""
+        if resume:
+            previous = next(self.replay(), None)
+            if previous == header:
+                self.file = open(self.path, 'a')
+                return True
+            log.warning('%s does not match this run, starting over', self.path)
+        self.file = open(self.path, 'w')
+        self.record(header)
+        return False
+
+    def record(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.file.flush()  # Hand every line to the OS, so it survives the process being killed
+
+    def close(self, remove=False):
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+
+def load_overrides(stop_ids, overrides_json=None):
+    """Platform overrides (route id -> platform) for a stand's stops"""
+    if overrides_json is None:
+        with open('overrides.json', 'r') as p_m:
+            overrides_json = json.loads(p_m.read().replace('\n', ''))
+    overrides = {}
+    for arg in stop_ids:
+        if arg in overrides_json.keys():
+            overrides.update(overrides_json[arg])
+    return overrides
+
+
+# Route catalogue (GetAllRouteList) configuration
+ROUTE_CATALOGUE_PATH = 'route_catalogue.json.gz'
+ROUTE_CATALOGUE_TTL_HOURS = 24  # How long the stored catalogue is used before checking the API for changes
+
+
+class RouteCatalogue:
+    """The routes returned by GetAllRouteList, indexed by routeid"""
+
+    def __init__(self, routes, content_hash=None, fetched_at=None, checked_at=None):
+        self.routes = routes
+        self.content_hash = content_hash or self.hash(routes)
+        self.fetched_at = fetched_at or time.time()  # When this content was first downloaded
+        self.checked_at = checked_at or self.fetched_at  # When the API last confirmed it
+        self.by_id = {route['routeid']: route for route in routes}
+
+    @staticmethod
+    def hash(routes):
+        return hashlib.sha256(json.dumps(routes, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+    @classmethod
+    def load(cls, path=ROUTE_CATALOGUE_PATH):
+        """The last good catalogue, None if there is none"""
+        try:
+            with gzip.open(path, 'rt') as file:
+                stored = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return cls(stored['routes'], stored['content_hash'], stored['fetched_at'], stored['checked_at'])
+
+    def save(self, path=ROUTE_CATALOGUE_PATH):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with gzip.open(tmp_path, 'wt') as file:
+            json.dump({'content_hash': self.content_hash, 'fetched_at': self.fetched_at,
+                       'checked_at': self.checked_at, 'routes': self.routes}, file, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def is_fresh(self):
+        return time.time() - self.checked_at < ROUTE_CATALOGUE_TTL_HOURS * 3600
+
+
+async def load_route_catalogue(client=None):
+    """
+    The route catalogue, shared by every stand and stage through ROUTE_CATALOGUE_PATH. The stored copy is used
+    as is for ROUTE_CATALOGUE_TTL_HOURS. After that the whole GetAllRouteList is downloaded again, the API has
+    no conditional request, and compared by content hash with the stored copy, which is only rewritten (rather
+    than just marked as checked) if it changed. If the API cannot be reached the last good copy is used
+    regardless of its age.
+    """
+    stored = RouteCatalogue.load()
+    if stored is not None and (stored.is_fresh() or client is None):
+        catalogue = stored
+    else:
+        try:
+            response_json = await client.post_json('GetAllRouteList', '{}')
+        except ApiError as e:
+            log.error('error fetching GetAllRouteList: %s', e)
+            response_json = {}
+        routes = response_json.get('data') or []
+        if not routes:
+            catalogue = stored or RouteCatalogue([])
+            if stored:
+                log.warning('using the route catalogue fetched at %s', time.ctime(stored.fetched_at))
+        elif stored is not None and RouteCatalogue.hash(routes) == stored.content_hash:
+            catalogue = stored
+            catalogue.checked_at = time.time()
+            catalogue.save()
+        else:
+            catalogue = RouteCatalogue(routes)
+            catalogue.save()
+            log.info('route catalogue changed, stored %s', ROUTE_CATALOGUE_PATH)
+    log.info('loaded %d routes from GetAllRouteList API', len(catalogue.by_id))
+    if len(catalogue.by_id) == 0:
+        log.warning('no routes loaded from GetAllRouteList API - this may cause issues with route metadata')
+    else:
+        log.debug('sample route ids: %s', list(catalogue.by_id.keys())[:5])
+    return catalogue
+
+
+# Build manifest configuration
+BUILD_MANIFEST_PATH = 'build-manifest.json'
+BUILD_MANIFEST_VERSION = 4  # Bump when a stage produces different output for the same inputs
+BUILD_STAGES = ('fetch', 'geojson', 'stops', 'merge')
+FETCH_MAX_AGE_HOURS = CACHE_DURATION_HOURS  # After this the API answers would be fetched again anyway
+CITYWIDE = '*'  # Manifest entry of the stages that are not per stand
+
+
+def file_hash(path):
+    """sha256 of a file's content, None if it does not exist"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def stage_key(*inputs):
+    """Hash of everything a stage's output depends on"""
+    return hashlib.sha256(
+        json.dumps([BUILD_MANIFEST_VERSION, *inputs], sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+class BuildManifest:
+    """
+    Input key and output hash of the last successful run of every stand's stages. A stage whose key is
+    unchanged and whose output has not been modified since is up to date and can be skipped.
+    """
+
+    def __init__(self, stands=None, path=BUILD_MANIFEST_PATH):
+        self.stands = stands or {}
+        self.path = path
+
+    @classmethod
+    def load(cls, path=BUILD_MANIFEST_PATH):
+        try:
+            with open(path, 'r') as file:
+                stored = json.load(file)
+        except (OSError, ValueError):
+            return cls(path=path)
+        if stored.get('version') != BUILD_MANIFEST_VERSION:
+            return cls(path=path)
+        return cls(stored['stands'], path)
+
+    def save(self):
+        write_json(self.path, {'version': BUILD_MANIFEST_VERSION, 'stands': self.stands})
+
+    def is_current(self, stand, stage, key, output, max_age=None):
+        entry = self.stands.get(stand, {}).get(stage)
+        if entry is None or entry['key'] != key:
+            return False
+        if max_age is not None and time.time() - entry['built_at'] > max_age:
+            return False
+        return file_hash(output) == entry['output']
+
+    def record(self, stand, stage, key, output):
+        self.stands.setdefault(stand, {})[stage] = {'key': key, 'output': file_hash(output), 'built_at': time.time()}
+
+    def forget(self, stand, stage):
+        self.stands.get(stand, {}).pop(stage, None)
+
+
+def fetch_key(stand, stop_ids, nest_level, overrides_json, flags):
+    return stage_key('fetch', stand, stop_ids, nest_level, bool(flags.get('coverage')),
+                     load_overrides(stop_ids, overrides_json), gtfs_feed_hash())
+
+
+def geojson_key(stand, stop_ids):
+    return stage_key('geojson', stand, stop_ids, file_hash(f'raw/platforms-{stand}.json'),
+                     file_hash(f'in/platforms-{stand}.geojson'), file_hash('stops-platforms.json'), gtfs_feed_hash())
+
+
+def stops_key(geojson_stage_key):
+    return stage_key('stops', geojson_stage_key, gtfs_feed_hash())
+
+
+def print_cache_stats():
+    try:
+        entries, size = init_cache_db().stats()
+        log.info('cache contains %d entries (%.1f MB)', entries, size / 1024 / 1024)
+        metrics.count('cache.entries', entries)
+    except Exception as e:
+        log.error('could not get cache statistics: %s', e)
+
+
+def save_platforms(stop_ids=None, file=None, nest_level=2, flags=None):
+    return asyncio.run(save_platforms_async(stop_ids, file, nest_level, flags))
+
+
+async def save_platforms_async(stop_ids=None, file=None, nest_level=2, flags=None):
+    log.info('starting save_platforms')
+    if stop_ids is None:
+        stop_ids, file, nest_level, flags = parse_stand_args()
     
     # Initialize cache database and cleanup expired entries
     init_cache_db()
     cleanup_expired_cache()
-    
-    overrides: dict
-    with open('overrides.json', 'r') as p_m:
-        overrides_json = json.loads(p_m.read().replace('\n', ''))
-        overrides = {}
-        # Extract nest_level from command-line arguments
-        if sys.argv[-1].isdigit():  # Check if the last argument is a number
-            nest_level = int(sys.argv[-1])
-            stop_ids = sys.argv[1:-2]  # Exclude the last two arguments (majestic and nest_level)
-        else:
-            nest_level = 2  # Default value if no nest_level is provided
-            stop_ids = sys.argv[1:-1]  # Exclude only the last argument (majestic)
 
-        for arg in stop_ids:
-            if arg in overrides_json.keys():
-                overrides.update(overrides_json[arg])
+    with metrics.stage('fetch'):
+        async with ApiClient() as client:
+            with metrics.stage('route_list'):
+                catalogue = await load_route_catalogue(client)
+            schedule_times = await search_platforms(client, catalogue.by_id, load_overrides(stop_ids), stop_ids, file,
+                                                    nest_level, flags or {})
+    print_cache_stats()
+    close_cache_db()
+
+    log.info('finished save_platforms')
+    return schedule_times
+
 
+async def search_platforms(client, routes, overrides, stop_ids, file, nest_level, flags):
+    """Discover the platforms serving one stand and write raw/platforms-<stand>.json"""
     next_stops = get_next_stops(stop_ids, nest_level=nest_level)
 
-    response = requests.post(f'{api_url}GetAllRouteList', headers=request_headers, data='{}')
-    try:
-        response_json = response.json()
-    except Exception as e:
-        print("Error decoding JSON from GetAllRouteList:", e)
-        print("Response text:", response.text)
-        response_json = {}
-    routes = {route['routeid']: route for route in response_json.get('data', [])}
-    print(f"Loaded {len(routes)} routes from GetAllRouteList API")
-    if len(routes) == 0:
-        print("Warning: No routes loaded from GetAllRouteList API - this may cause issues with route metadata")
-    else:
-        print(f"Sample route IDs: {list(routes.keys())[:5]}")
+    score = None
+    expected_routes = set()
+    if flags.get('coverage'):
+        # Only look for the routes the gtfs says leave this stand within reach of the search, most promising
+        # destinations first. Trips ending at the stand can never be returned for an origin -> onward pair
+        gtfs = load_gtfs_graph()
+        downstream = {stop: gtfs.downstream_routes(stop, nest_level) for stop in stop_ids}
+        expected_routes = set().union(*(routes for stop in downstream.values() for routes in stop.values()))
+        log.info('coverage mode: expecting %d routes at %s', len(expected_routes), file)
+
+        def score(origin, stop):
+            return len(downstream[origin].get(stop, set()) & uncovered_routes[origin])
+    # Origin -> expected routes it could still report a platform for. A route leaves every origin's set once it
+    # has a platform, but an answer without one only rules out the origin that gave it
+    uncovered_routes = {stop: set().union(*downstream[stop].values()) for stop in stop_ids} if expected_routes else {}
 
     schedule_times = {"Failed": [], "Received": []}
+    received = {}  # route-id -> received entry
     routes_done = set()
-    routes_done_lock = threading.Lock()
-    received_lock = threading.Lock()
-    failed_lock = threading.Lock()
     failed_stops = set()
-    failed_stops_lock = threading.Lock()
-    s = {l: set() for l in range(nest_level + 1)}
+    # Origins answer in whatever order their requests complete, the entry kept for a route is the one from the
+    # earliest origin in stop_ids (with a platform over without), as if the origins had been searched in turn
+    origin_rank = {stop: index for index, stop in enumerate(stop_ids)}
+    kept_rank = {}  # route-id -> entry_rank of its received entry
+
+    def entry_rank(origin, pf_name, pf_num):
+        return not ((pf_name and pf_name != "") or (pf_num and pf_num != "")), origin_rank.get(origin, len(stop_ids))
 
-    file = sys.argv[-1] if not sys.argv[-1].isdigit() else sys.argv[-2]
     if os.path.exists(f'raw/platforms-{file}.json'):
         with open(f'raw/platforms-{file}.json', 'r') as p_m:
             x = json.loads(p_m.read())
             # Load only successful entries from previous run, reset failed entries
-            schedule_times["Received"] = x.get('Received', [])
+            received = {entry["route-id"]: entry for entry in x.get('Received', [])}
+
+    def mark_done(origin, route_id, pf_name, pf_num):
+        if (pf_name and pf_name != "") or (pf_num and pf_num != ""): # Add only if platform is populated
+            routes_done.add(route_id)
+            for routes in uncovered_routes.values():
+                routes.discard(str(route_id))
+        elif origin in uncovered_routes:
+            # Other pairs of this origin report the same route the same way, other origins may not
+            uncovered_routes[origin].discard(str(route_id))
+
+    # Everything completed is journaled as it happens, --resume picks up from the journal of a killed run
+    journal = RunJournal(f'raw/platforms-{file}.journal.jsonl')
+    completed = {}
+    if journal.open({"stand": file, "stop_ids": stop_ids, "nest_level": nest_level}, resume=flags.get('resume')):
+        for record in journal.replay():
+            if "request" in record:
+                completed[tuple(record["request"])] = record["failed"]
+                if record["failed"]:
+                    schedule_times["Failed"].append({
+                        "from_stop": record["request"][0],
+                        "to_stop": record["request"][1],
+                        "message": record.get("message"),
+                        "level": record["level"]
+                    })
+            elif "received" in record:
+                entry = record["received"]
+                received[entry["route-id"]] = entry
+                kept_rank[entry["route-id"]] = entry_rank(record.get("origin"), entry["platform-name"],
+                                                          entry["platform-number"])
+                mark_done(record.get("origin"), entry["route-id"], entry["platform-name"], entry["platform-number"])
+            elif "answered" in record:
+                mark_done(record["origin"], record["answered"], None, None)
+        log.info('resuming %s: %d requests already done, %d routes with a platform', file, len(completed),
+                 len(routes_done))
     tomorrow_start = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime('%Y-%m-%d 00:00')
     tomorrow_end = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime('%Y-%m-%d 23:59')
 
-    def send_request(from_stop, to_stop):
-        print(f'        sending request {from_stop} to {to_stop}')
+    refreshes = {}  # Background refreshes of stale cache entries
+
+    async def fetch(client, from_stop, to_stop):
         data = f'''
             {{
             "fromStationId":{int(from_stop)},
@@ -254,10 +1400,24 @@ def save_platforms():
             "p_date":"{tomorrow_start}"
             }}
         '''
-        
+        log.debug('sending request %s to %s', from_stop, to_stop)
+        response = await client.post_json('GetTimetableByStation_v4', data, share=file)
+        store_cached_response(from_stop, to_stop, response)
+        return response
+
+    async def refresh(client, from_stop, to_stop):
+        try:
+            await fetch(client, from_stop, to_stop)
+        except ApiError as e:
+            log.warning('could not refresh %s -> %s: %s', from_stop, to_stop, e)
+
+    async def send_request(client, from_stop, to_stop):
         # Check cache first
-        cached_response = get_cached_response(from_stop, to_stop, data)
+        cached_response, stale = get_cached_response(from_stop, to_stop)
         if cached_response is not None:
+            if stale and (from_stop, to_stop) not in refreshes:
+                # Serve the stale answer now, the refreshed one is picked up by the next run
+                refreshes[(from_stop, to_stop)] = asyncio.ensure_future(refresh(client, from_stop, to_stop))
             # Return cached response
             is_failed = (
                 cached_response.get("exception") not in (None, False) or
@@ -267,16 +1427,12 @@ def save_platforms():
             return from_stop, to_stop, cached_response, is_failed
         
         # If not in cache, make actual API call
-        print(f'        sending request {from_stop} to {to_stop}')
-        now = time.time()
         try:
-            response = requests.post(f'{api_url}GetTimetableByStation_v4', headers=request_headers, data=data).json()
-        except:
-            response = {"isException": True, "Issuccess": False, "exception": "Response not received in JSON.",
-                        "Message": "Response not received in JSON."}
-
-        # Store response in cache
-        store_cached_response(from_stop, to_stop, data, response)
+            response = await fetch(client, from_stop, to_stop)
+        except ApiError as e:
+            # Retries exhausted, report this pair as failed for this run but keep it out of the cache
+            response = {"isException": True, "Issuccess": False, "exception": str(e), "Message": str(e)}
+            return from_stop, to_stop, response, True
 
         is_failed = (
                 response.get("exception") not in (None, False) or
@@ -286,124 +1442,213 @@ def save_platforms():
         return from_stop, to_stop, response, is_failed
 
     # Main execution
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        for stop in stop_ids:
-            print(f'processing stop {stop}')
-            s[0].add(stop)
-            for level in range(nest_level):
-                has_failures = False
-                futures = []
-                print(f'    processing level {level}')
-                print(f'        processing stops at level {level}: {list(s[level])}')
-                for b in s[level]:
-                    if b not in next_stops:
-                        continue
-                    for n in next_stops[b]:
-                        futures.append(executor.submit(send_request, stop, n))
-
-                for future in as_completed(futures):
-                    from_stop, to_stop, response, is_failed = future.result()
-                    if is_failed:
-                        # Log the failed query
-                        with failed_lock:
-                            schedule_times["Failed"].append({
-                                "from_stop": from_stop,
-                                "to_stop": to_stop,
-                                "response": response,
-                                "level": level
-                            })
-                        with failed_stops_lock:
-                            if level == nest_level - 1:
-                                failed_stops.add(from_stop)
-                        # Only add to next level if this path failed (we need to explore further)
-                        s[level + 1].add(to_stop)
-                        print(f'        failed: {from_stop} -> {to_stop}, adding {to_stop} to level {level + 1}')
-                        has_failures = True
-                    else:
-                        print(f'        success: {from_stop} -> {to_stop}, NOT adding {to_stop} to next level')
-                        for route_entry in response.get("data", []):
-                            route_id = route_entry["routeid"]
-                            pf_name = overrides.get(str(route_id), route_entry["platformname"])
-                            pf_num = overrides.get(str(route_id), route_entry["platformnumber"])
-                            with routes_done_lock:
-                                if route_id in routes_done:
-                                    continue
-                                if (pf_name and pf_name != "") or (pf_num and pf_num != ""): # Add only if platform is populated
-                                    routes_done.add(route_id)
-                            with received_lock:
-                                # Check if route_id exists in routes dictionary
-                                if route_id not in routes:
-                                    print(f"        warning: route_id {route_id} not found in routes dictionary, skipping")
-                                    continue
-                                
-                                # Create new entry
-                                new_entry = {
-                                    "route-number": route_entry['routeno'],
-                                    "extended-route-number": routes[route_id]['routeno'],
-                                    "route-name": route_entry["routename"],
-                                    "start-station": routes[route_id]['fromstation'],
-                                    "start-station-id": routes[route_id]['fromstationid'],
-                                    "from-station-id": route_entry['fromstationid'],
-                                    "route-id": route_id,
-                                    "to-station-id": routes[route_id]["tostationid"],
-                                    "to-station": routes[route_id]["tostation"],
-                                    "platform-name": overrides.get(str(route_id), route_entry["platformname"]),
-                                    "platform-number": overrides.get(str(route_id), route_entry["platformnumber"]),
-                                    "bay-number": route_entry["baynumber"]
-                                }
-                                
-                                # Check if entry already exists and update it, otherwise add new entry
-                                existing_index = None
-                                for i, existing_entry in enumerate(schedule_times["Received"]):
-                                    if existing_entry.get("route-id") == route_id:
-                                        existing_index = i
-                                        break
-                                
-                                if existing_index is not None:
-                                    # Update existing entry
-                                    schedule_times["Received"][existing_index] = new_entry
-                                else:
-                                    # Add new entry
-                                    schedule_times["Received"].append(new_entry)
-                
-                # If no failures at this level, we can stop (all successful)
-                if not has_failures:
-                    print(f'    all requests successful at level {level}, stopping')
-                    break
-    with open(f'raw/platforms-{file}.json', 'w') as p_m:
-        p_m.write(json.dumps(schedule_times, indent=2))
-    
-    # Print cache statistics
-    try:
-        conn = sqlite3.connect(CACHE_DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM api_cache')
-        total_cached = cursor.fetchone()[0]
-        conn.close()
-        print(f'Cache contains {total_cached} entries')
-    except Exception as e:
-        print(f'Could not get cache statistics: {e}')
-    
-    print('finished save_platforms')
+    def handle_result(from_stop, to_stop, response, is_failed, level):
+        metrics.count(f'search.{"failed" if is_failed else "succeeded"}.level.{level}')
+        if is_failed:
+            # Log the failed query, without the response to keep memory flat
+            schedule_times["Failed"].append({
+                "from_stop": from_stop,
+                "to_stop": to_stop,
+                "message": response.get("Message"),
+                "level": level
+            })
+            if level == nest_level - 1:
+                failed_stops.add(from_stop)
+            # Only explore past this stop if this path failed
+            log.debug('failed: %s -> %s, expanding %s to level %d', from_stop, to_stop, to_stop, level + 1)
+        else:
+            log.debug('success: %s -> %s, NOT expanding %s', from_stop, to_stop, to_stop)
+            handle_routes(from_stop, response)
+        # Journaled last, --resume only skips a pair once everything it returned is in the journal
+        journal.record({"request": [from_stop, to_stop], "level": level, "failed": is_failed,
+                        **({"message": response.get("Message")} if is_failed else {})})
+
+    def handle_routes(origin, response):
+        for route_entry in response.get("data", []):
+            route_id = route_entry["routeid"]
+            pf_name = overrides.get(str(route_id), route_entry["platformname"])
+            pf_num = overrides.get(str(route_id), route_entry["platformnumber"])
+            # Every answer counts for coverage, only the entry kept depends on its rank
+            mark_done(origin, route_id, pf_name, pf_num)
+            if expected_routes and not any(uncovered_routes.values()) and not search.stopped:
+                log.info('every expected route has a platform or has been answered by every origin at %s, '
+                         'stopping', file)
+                search.stop()
+            rank = entry_rank(origin, pf_name, pf_num)
+            if route_id in kept_rank and kept_rank[route_id] <= rank:
+                if expected_routes and rank[0]:
+                    journal.record({"answered": route_id, "origin": origin})  # So --resume rules the origin out
+                continue
+            kept_rank[route_id] = rank
+            # Check if route_id exists in routes dictionary
+            if route_id not in routes:
+                log.warning('route_id %s not found in routes dictionary, skipping', route_id)
+                metrics.count('search.unknown_route')
+                continue
+
+            # Create new entry
+            new_entry = {
+                "route-number": route_entry['routeno'],
+                "extended-route-number": routes[route_id]['routeno'],
+                "route-name": route_entry["routename"],
+                "start-station": routes[route_id]['fromstation'],
+                "start-station-id": routes[route_id]['fromstationid'],
+                "from-station-id": route_entry['fromstationid'],
+                "route-id": route_id,
+                "to-station-id": routes[route_id]["tostationid"],
+                "to-station": routes[route_id]["tostation"],
+                "platform-name": overrides.get(str(route_id), route_entry["platformname"]),
+                "platform-number": overrides.get(str(route_id), route_entry["platformnumber"]),
+                "bay-number": route_entry["baynumber"]
+            }
+
+            # Update the existing entry or add a new one. Results are only ever handled on the event loop
+            # thread, so this needs no locking
+            received[route_id] = new_entry
+            journal.record({"received": new_entry, "origin": origin})
+
+    # Every stop is explored concurrently, pairs are queued as their parent fails
+    search = PlatformSearch(stop_ids, next_stops, nest_level,
+                            lambda origin, stop: send_request(client, origin, stop), handle_result, score, completed)
+    if expected_routes and not any(uncovered_routes.values()):
+        search.stop()  # A resumed run that had already found everything
+    with metrics.stage('search'):
+        await search.run(workers=client.concurrency)
+    metrics.count('search.requested', search.requested)
+    log.info('%s: %d requests, %d routes received', file, search.requested, len(received))
+    if expected_routes:
+        missing = expected_routes - {str(route_id) for route_id in kept_rank}
+        log.info('covered %d of %d expected routes with %d requests', len(expected_routes) - len(missing),
+                 len(expected_routes), search.requested)
+        if missing:
+            log.info('expected routes never returned: %s', sorted(missing))
+            schedule_times["Missing"] = sorted(missing)
+        no_platform = expected_routes - missing - {str(route_id) for route_id in routes_done}
+        if no_platform:
+            log.info('expected routes returned without a platform: %s', sorted(no_platform))
+            schedule_times["NoPlatform"] = sorted(no_platform)
+    if refreshes:
+        log.info('waiting for %d stale cache entries to refresh', len(refreshes))
+        await asyncio.gather(*refreshes.values())
+    # Ordered by route-id and pair so reruns only differ where the data does
+    schedule_times["Received"] = [received[route_id] for route_id in sorted(received)]
+    schedule_times["Failed"].sort(key=lambda failed: (str(failed["from_stop"]), str(failed["to_stop"]),
+                                                      failed["level"]))
+    write_json(f'raw/platforms-{file}.json', schedule_times)
+    journal.close(remove=True)  # Everything is in the raw file now
     return schedule_times
 
 
-def geo_json():
+# Platform resolver configuration
+RESOLVE_ALIAS_CONFIDENCE = 0.9  # A reported platform that only matches a platform or alias once normalized
+RESOLVE_MAX_DISTANCE_METERS = 300  # A stop further than this from every platform is not matched to one
+RESOLVE_MIN_CONFIDENCE = 0.5  # Less confident matches are left in help/ to be sorted by hand
+
+
+def normalize_platform(name):
+    """'Platform 02', 'pf-2' and '2' all normalize to '2', None to ''"""
+    if name is None:
+        return ''
+    name = re.sub(r'[^0-9A-Z]', '', str(name).upper())
+    name = re.sub(r'^(PLATFORM|PF)(?=[0-9])', '', name)
+    return re.sub(r'^0+(?=[0-9])', '', name)
+
+
+class PlatformResolver:
+    """
+    Sorts the routes of a stand that geo_json could not match exactly. A reported platform name or number is
+    normalized and looked up among the normalized platform names and aliases of the stand. Failing that, the
+    route goes to the platform closest to the stop it was reported at (from-station-id in stops.txt), with a
+    confidence that falls with the distance to that platform and with how close the next platform is.
+    """
+
+    def __init__(self, features, gtfs):
+        self.gtfs = gtfs
+        self.aliases = {}  # Normalized name -> platform, None if it names several platforms
+        self.names = []
+        lats, lons = array('d'), array('d')
+        for feature in features:
+            if feature["geometry"]["type"] != "Point":
+                continue
+            platform = feature["properties"]["Platform"]
+            for name in [platform, *feature["properties"].get("Alias", [])]:
+                key = normalize_platform(name)
+                if key:
+                    self.aliases[key] = platform if self.aliases.get(key, platform) == platform else None
+            self.names.append(platform)
+            lons.append(feature["geometry"]["coordinates"][0])
+            lats.append(feature["geometry"]["coordinates"][1])
+        self.lats, self.lons = lats, lons
+
+    def resolve(self, routes):
+        """(platform, method, confidence) for each route, platform is None if there is no match at all"""
+        resolved = [None] * len(routes)
+        nearest = []  # Indexes of the routes left to place by distance
+        for i, route in enumerate(routes):
+            for name in (route['platform-name'], route['platform-number']):
+                platform = self.aliases.get(normalize_platform(name))
+                if platform is not None:
+                    resolved[i] = (platform, 'alias', RESOLVE_ALIAS_CONFIDENCE)
+                    break
+            else:
+                nearest.append(i)
+
+        stops = list(dict.fromkeys(str(routes[i]['from-station-id']) for i in nearest))
+        locations = {stop: self.gtfs.stop_location(stop) for stop in stops}
+        located = [stop for stop in stops if locations[stop] is not None]
+        matches = dict(zip(located, self.nearest([locations[stop] for stop in located])))
+        for i in nearest:
+            platform, confidence = matches.get(str(routes[i]['from-station-id']), (None, 0.0))
+            if platform is not None:
+                resolved[i] = (platform, 'nearest', confidence)
+        return [result or (None, None, 0.0) for result in resolved]
+
+    def nearest(self, points):
+        """The closest platform to each [lat, lon] with its confidence, in one vectorized pass if NumPy is installed"""
+        if not points or not self.names:
+            return [(None, 0.0)] * len(points)
+        if numpy is not None:
+            lat1, lon1 = numpy.radians(numpy.array(points, dtype=float)).T[:, :, None]
+            lat2, lon2 = numpy.radians(numpy.frombuffer(self.lats)), numpy.radians(numpy.frombuffer(self.lons))
+            a = numpy.sin((lat2 - lat1) / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+            distances = 2 * EARTH_RADIUS_METERS * numpy.arcsin(numpy.sqrt(a))
+            closest = distances.argmin(axis=1).tolist()
+            smallest = numpy.sort(distances, axis=1)[:, :2].tolist()
+        else:
+            closest, smallest = [], []
+            for lat, lon in points:
+                row = [distance_meters(lat, lon, plat, plon) for plat, plon in zip(self.lats, self.lons)]
+                closest.append(min(range(len(row)), key=row.__getitem__))
+                smallest.append(sorted(row)[:2])
+        results = []
+        for index, (first, *second) in zip(closest, smallest):
+            # 1 if the next platform is much further away than the closest one, 0 if it is as close
+            margin = (1 - first / second[0] if second[0] > 0 else 0.0) if second else 1.0
+            confidence = max(0.0, 1 - first / RESOLVE_MAX_DISTANCE_METERS) * margin
+            results.append((self.names[index], round(confidence, 3)))
+        return results
+
+
+@metrics.stage('geojson')
+def geo_json(stop_ids=None, file=None, platforms_raw=None, write_output=True):
+    """
+    Sort a stand's received routes onto the platforms of in/platforms-<stand>.geojson. The raw data is read
+    from raw/platforms-<stand>.json unless it is passed in, and the output is only written if write_output.
+    """
     platforms_geo: dict  # Platform: List of routes
     geojson_json: dict
     platforms_raw: dict
     stops_platforms: dict
-    stops_loc: dict
-    with open(f"{gtfs_folder}stops.txt", mode='r') as file:
-        reader = csv.DictReader(file)
-        stops_loc = {row["stop_id"]: [float(row["stop_lat"]), float(row["stop_lon"])] for row in reader}
+    gtfs = load_gtfs_graph()
     with open('stops-platforms.json', 'r') as p_m:
-        stops_platforms = json.loads(p_m.read().replace('\n', ''))
-    file = sys.argv[-1] if not sys.argv[-1].isdigit() else sys.argv[-2]
-    with open(f'raw/platforms-{file}.json', 'r') as p_m:
-        platforms_raw = json.loads(p_m.read().replace('\n', ''))
+        stops_platforms = json.load(p_m)
+    if stop_ids is None:
+        stop_ids, file, _, _ = parse_stand_args()
+    if platforms_raw is None:
+        with open(f'raw/platforms-{file}.json', 'r') as p_m:
+            platforms_raw = json.load(p_m)
     with open(f'in/platforms-{file}.geojson', 'r') as p_m_g:
-        geojson_json = json.loads(p_m_g.read().replace('\n', ''))
+        geojson_json = json.load(p_m_g)
         for feature in geojson_json["features"]:
             feature["properties"]["Platform"] = str(feature["properties"]["Platform"]).upper()
         platforms_geo = {}
@@ -422,7 +1667,8 @@ def geo_json():
     stop_names = []
     # Add stops (not identified as platforms by BMTC API) to geojson and platforms_geo
     for stop_id, stop_name in stops_platforms.items():
-        if stop_id in stops_loc and stop_id in sys.argv:
+        stop_loc = gtfs.stop_location(stop_id)
+        if stop_loc is not None and stop_id in stop_ids:
             platforms_geo[stop_name] = []
             if stop_name in platforms_names or stop_name in stop_names:
                 continue
@@ -432,7 +1678,7 @@ def geo_json():
                 "geometry": {
                     "type": "Point",
                     "coordinates": [
-                        stops_loc[stop_id][1], stops_loc[stop_id][0]
+                        stop_loc[1], stop_loc[0]
                     ]
                 },
                 "properties": {
@@ -450,6 +1696,20 @@ def geo_json():
             platforms_geo[platform].append(route)
             continue
         platforms_geo["Unsorted"].append(route)
+    # Place what did not match exactly, only the matches it is not confident about are left for help/
+    resolver = PlatformResolver(geojson_json["features"], gtfs)
+    resolved = []
+    for bucket in ("Unknown", "Unsorted"):
+        routes, platforms_geo[bucket] = platforms_geo[bucket], []
+        for route, (platform, method, confidence) in zip(routes, resolver.resolve(routes)):
+            route = {**route, "resolved-platform": platform, "resolved-by": method, "confidence": confidence}
+            if platform is not None and confidence >= RESOLVE_MIN_CONFIDENCE:
+                platforms_geo[platform].append(route)
+                resolved.append(route)
+                metrics.count(f'resolve.{method}')
+            else:
+                platforms_geo[bucket].append(route)
+                metrics.count('resolve.unsorted')
     for feature in geojson_json["features"]:
         if feature["geometry"]["type"] == "Point":
             feature["properties"]["Routes"] = [{
@@ -458,7 +1718,9 @@ def geo_json():
                 "From": route['from-station-id'],
                 "UniqueName": route['route-name'],
                 "Id": route['route-id'],
-                "BayReported": route['bay-number']
+                "BayReported": route['bay-number'],
+                "Match": route.get('resolved-by', 'reported'),
+                "Confidence": route.get('confidence', 1.0)
             } for route in platforms_geo[str(feature["properties"]["Platform"])]]
             if "Alias" in feature["properties"].keys():
                 for alias in feature["properties"]["Alias"]:
@@ -468,72 +1730,904 @@ def geo_json():
                         "From": route['from-station-id'],
                         "UniqueName": route['route-name'],
                         "Id": route['route-id'],
-                        "BayReported": route['bay-number']
+                        "BayReported": route['bay-number'],
+                        "Match": route.get('resolved-by', 'reported'),
+                        "Confidence": route.get('confidence', 1.0)
                     } for route in platforms_geo[str(alias)]])
 
-    # Save all data. Unknown and Unsorted as well.
-    with open(f'out/platforms-routes-{file}.geojson', 'w') as p_m_g:
-        p_m_g.write(json.dumps(geojson_json, indent=2))
-    if (len(platforms_geo["Unknown"]) > 0) or (len(platforms_geo["Unsorted"]) > 0):
-        with open(f'help/platforms-unaccounted-{file}.json', 'w') as p_u:
-            p_u.write(
-                json.dumps({"Unknown": platforms_geo["Unknown"], "Unsorted": platforms_geo["Unsorted"]}, indent=2))
+    # Save all data. Unknown, Unsorted and Resolved as well.
+    if write_output:
+        write_json(f'out/platforms-routes-{file}.geojson', geojson_json)
+    if platforms_geo["Unknown"] or platforms_geo["Unsorted"] or resolved:
+        write_json(f'help/platforms-unaccounted-{file}.json',
+                   {"Unknown": platforms_geo["Unknown"], "Unsorted": platforms_geo["Unsorted"], "Resolved": resolved})
 
     return geojson_json
 
 
-def add_routes_gtfs_geojson():
-    # Extract nest_level from command-line arguments
-    if sys.argv[-1].isdigit():  # Check if the last argument is a number
-        stop_ids = sys.argv[1:-2]  # Exclude the last two arguments (majestic and nest_level)
-    else:
-        stop_ids = sys.argv[1:-1]  # Exclude only the last argument (majestic)
-    geojson_json: dict
-    file = sys.argv[-1] if not sys.argv[-1].isdigit() else sys.argv[-2]
-    with (open(f'out/platforms-routes-{file}.geojson', 'r') as p_m_g):
-        geojson_json = json.loads(p_m_g.read().replace('\n', ''))
-
-    def get_dicts(filename) -> list[dict]:
-        data = []
-        with open(f'{gtfs_folder}{filename}', 'r') as csv_file:
-            reader = csv.DictReader(csv_file)
-            data = [dict(read) for read in reader]
-        return data
-
-    def group_by(key, li: list):
-        # Group values by 'id' and honor the sequence value
-        grouped_data = {}
-        for item in li:
-            if item[key] not in grouped_data.keys():
-                grouped_data[item[key]] = []
-            grouped_data[item[key]].append(item)
-        return grouped_data
-
-    stops = {stop["stop_id"]: stop["stop_name"] for stop in get_dicts('stops.txt')}
-
-    trips = group_by('route_id', get_dicts('trips.txt'))
-    stop_times = {
-        key:
-            sorted(items, key=lambda x: int(x['stop_sequence']))
-        for key, items in group_by('trip_id', get_dicts('stop_times.txt')).items()
-    }
+@metrics.stage('stops')
+def add_routes_gtfs_geojson(stop_ids=None, file=None, geojson_json=None):
+    """Add the gtfs stops of every route to a stand's output, read from out/ unless it is passed in"""
+    if stop_ids is None:
+        stop_ids, file, _, _ = parse_stand_args()
+    if geojson_json is None:
+        with open(f'out/platforms-routes-{file}.geojson', 'r') as p_m_g:
+            geojson_json = json.load(p_m_g)
+    previous = None  # The output this run replaces, only needed to start the change feed of a stand
+    if not os.path.exists(f'{DELTAS_DIR}/{file}/published.json') and \
+            os.path.exists(f'out/platforms-routes-{file}.geojson'):
+        with open(f'out/platforms-routes-{file}.geojson', 'r') as p_m_g:
+            previous = json.load(p_m_g)
+
+    gtfs = load_gtfs_graph()
+    starts = gtfs.pattern_starts(stop_ids)
+    stops_by_route = {}  # A route on several platforms shares one list
     for feature in geojson_json["features"]:
         for route in feature["properties"]["Routes"]:
-            stops_now = []
-            if trips.keys().__contains__(str(route["Id"])):
-                loop_stops = stop_times[trips[str(route["Id"])][0]["trip_id"]]
-                loop_stops = loop_stops[next((i for i, stop in enumerate(loop_stops) if stop['stop_id'] in stop_ids), None):]
-                for stop in loop_stops:
-                    stops_now.append(stops[stop['stop_id']])
-            route["Stops"] = stops_now
-    with open(f'out/platforms-routes-{file}.geojson', 'w') as p_m_g:
-        p_m_g.write(json.dumps(geojson_json, indent=2))
+            route_id = str(route["Id"])
+            if route_id not in stops_by_route:
+                stops_by_route[route_id] = gtfs.route_stop_names(route_id, starts)
+            route["Stops"] = stops_by_route[route_id]
+    write_json(f'out/platforms-routes-{file}.geojson', geojson_json)
+    write_compact(f'out/platforms-routes-{file}.compact.bin', geojson_json)
+    write_delta(file, geojson_json, previous)
+    return geojson_json
+
+
+# Compact output configuration
+COMPACT_MAGIC = b'BMTCPLAT'
+COMPACT_VERSION = 2
+COMPACT_ROUTE_FIELDS = ('Name', 'Destination', 'From', 'UniqueName', 'Id', 'BayReported', 'Stops', 'Match',
+                        'Confidence')
+COMPACT_STRING_FIELDS = ('Name', 'Destination', 'UniqueName', 'Match')
+COMPACT_MILLI_FIELDS = ('Confidence',)  # Stored in thousandths
+COMPACT_NULL = -0x80000000
+
+
+def encode_compact(geojson_json):
+    """
+    Dictionary-encode a stand's output for clients that do not need GeoJSON. Laid out like the gtfs snapshot
+    (magic, version, header length, JSON header, then 4-byte aligned little-endian arrays):
+
+    - the header holds the GeoJSON with every "Routes" list replaced by its length, plus the array layout
+    - `strings`: the route names, destinations and stop names as NUL-separated UTF-8
+    - `routes`: one row of COMPACT_ROUTE_FIELDS per route, in feature order, as int32. String fields are indexes
+      into strings, Stops an index into the stop lists, Confidence in thousandths and null is COMPACT_NULL
+    - `stop_offsets` / `stop_names`: every distinct stop list, CSR-style, as indexes into strings
+    """
+    strings = {}
+    stop_lists = {}
+    routes = array('i')
+    features = []
+    for feature in geojson_json["features"]:
+        properties = dict(feature["properties"])
+        if "Routes" in properties:
+            for route in properties["Routes"]:
+                for field in COMPACT_ROUTE_FIELDS:
+                    value = route[field]
+                    if value is None:
+                        value = COMPACT_NULL
+                    elif field in COMPACT_STRING_FIELDS:
+                        value = strings.setdefault(value, len(strings))
+                    elif field in COMPACT_MILLI_FIELDS:
+                        value = round(value * 1000)
+                    elif field == 'Stops':
+                        stops = tuple(strings.setdefault(stop, len(strings)) for stop in value)
+                        value = stop_lists.setdefault(stops, len(stop_lists))
+                    routes.append(value)
+            properties["Routes"] = len(properties["Routes"])
+        features.append({**feature, "properties": properties})
+
+    stop_offsets = array('I', [0])
+    stop_names = array('H' if len(strings) <= 0xFFFF else 'I')
+    for stops in stop_lists:
+        stop_names.extend(stops)
+        stop_offsets.append(len(stop_names))
+    arrays = {
+        'strings': array('B', '\0'.join(strings).encode()),
+        'routes': routes,
+        'stop_offsets': stop_offsets,
+        'stop_names': stop_names,
+    }
+
+    layout = {}
+    body = bytearray()
+    for name, values in arrays.items():
+        layout[name] = [values.typecode, len(body), len(values)]
+        if sys.byteorder == 'big':
+            values.byteswap()
+        body += values.tobytes()
+        body += b'\0' * (-len(body) % 4)
+    header = json.dumps({'arrays': layout, 'geojson': {**geojson_json, "features": features}},
+                        separators=(',', ':')).encode()
+    header += b' ' * (-(len(COMPACT_MAGIC) + 8 + len(header)) % 4)
+    return COMPACT_MAGIC + struct.pack('<II', COMPACT_VERSION, len(header)) + header + body
+
+
+def compact_tables(data):
+    """The header, string table and arrays of a compact file, without building the GeoJSON"""
+    if data[:len(COMPACT_MAGIC)] != COMPACT_MAGIC:
+        raise ValueError('Not a compact platforms file')
+    start = len(COMPACT_MAGIC)
+    version, header_length = struct.unpack('<II', data[start:start + 8])
+    if version != COMPACT_VERSION:
+        raise ValueError(f'Compact platforms file version {version}, expected {COMPACT_VERSION}')
+    start += 8
+    header = json.loads(data[start:start + header_length])
+    start += header_length
+    arrays = {}
+    for name, (typecode, offset, count) in header['arrays'].items():
+        values = array(typecode)
+        values.frombytes(data[start + offset:start + offset + count * values.itemsize])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        arrays[name] = values
+    return header, arrays['strings'].tobytes().decode().split('\0'), arrays
+
+
+def decode_compact(data):
+    """
+    Turn the output of encode_compact back into the GeoJSON it was made from. Fields are decoded a column at a
+    time and every distinct stop list once, rather than value by value.
+    """
+    header, strings, arrays = compact_tables(data)
+    stop_offsets, stop_names = arrays['stop_offsets'], arrays['stop_names']
+    routes = arrays['routes']
+    width = len(COMPACT_ROUTE_FIELDS)
+    stop_names = list(map(strings.__getitem__, stop_names))
+    stop_lists = [stop_names[stop_offsets[s]:stop_offsets[s + 1]] for s in range(len(stop_offsets) - 1)]
+    columns = []
+    for column, field in enumerate(COMPACT_ROUTE_FIELDS):
+        values = routes[column::width]
+        if field in COMPACT_STRING_FIELDS:
+            columns.append([None if value == COMPACT_NULL else strings[value] for value in values])
+        elif field in COMPACT_MILLI_FIELDS:
+            columns.append([None if value == COMPACT_NULL else value / 1000 for value in values])
+        elif field == 'Stops':
+            columns.append([None if value == COMPACT_NULL else stop_lists[value][:] for value in values])
+        else:
+            columns.append([None if value == COMPACT_NULL else value for value in values])
+    route_objects = [dict(zip(COMPACT_ROUTE_FIELDS, row)) for row in zip(*columns)]
+    row = 0
+    features = []
+    for feature in header['geojson']["features"]:
+        properties = feature["properties"]
+        if "Routes" in properties:
+            properties["Routes"], row = route_objects[row:row + properties["Routes"]], row + properties["Routes"]
+        features.append(feature)
+    return {**header['geojson'], "features": features}
+
+
+def write_compact(path, geojson_json):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(encode_compact(geojson_json))
+    os.replace(tmp_path, path)
+
+
+def read_compact(path):
+    """Read an out/platforms-routes-<stand>.compact.bin file as the equivalent GeoJSON"""
+    with open(path, 'rb') as file:
+        return decode_compact(file.read())
+
+
+# Change feed configuration
+DELTAS_DIR = 'out/deltas'
+DELTA_FORMAT = 'bmtc-platforms-delta'
+DELTA_VERSION = 2  # 2 keys changes by feature index instead of platform name
+
+
+def geojson_hash(geojson_json):
+    """Hash of a stand output as write_json writes it, so it matches file_hash of the written file"""
+    return hashlib.sha256(json.dumps(geojson_json, indent=2).encode()).hexdigest()
+
+
+def route_changes(old, new):
+    """
+    The route level changes turning one output of a stand into the next, keyed by the index of the platform's
+    feature (names repeat, e.g. two features of a platform at either end of it) and route id:
+
+    - `{"op": "add", "feature", "route", "index", "value"}`: a route appeared at a platform
+    - `{"op": "remove", "feature", "route"}`: a route no longer leaves from a platform
+    - `{"op": "move", "from", "feature", "route", "index", "set"}`: a route changed platform, with its other
+      changed fields
+    - `{"op": "update", "feature", "route", "set"}`: changed fields of a route, e.g. BayReported or Stops
+    - `{"op": "routes", "feature", "value"}`: every route of a platform, when the order of its routes changed
+
+    None if anything but the routes changed (platforms added, moved or renamed in in/).
+    """
+    def skeleton(geojson_json):
+        return {**geojson_json, "features": [
+            {**feature, "properties": {**feature["properties"], "Routes": None}} for feature in geojson_json["features"]]}
+    if skeleton(old) != skeleton(new):
+        return None
+
+    def by_route(geojson_json):
+        routes = {}
+        for feature_index, feature in enumerate(geojson_json["features"]):
+            for index, route in enumerate(feature["properties"].get("Routes", [])):
+                routes.setdefault(route["Id"], []).append((feature_index, index, route))
+        return routes
+    old_routes, new_routes = by_route(old), by_route(new)
+
+    changes = []
+    for route_id in sorted(set(old_routes) | set(new_routes), key=str):
+        before = {feature: route for feature, _, route in old_routes.get(route_id, [])}
+        after = {feature: (index, route) for feature, index, route in new_routes.get(route_id, [])}
+        removed = [feature for feature in before if feature not in after]
+        for feature, (index, route) in after.items():
+            if feature in before:
+                changed = {field: value for field, value in route.items() if before[feature].get(field) != value}
+                if changed:
+                    changes.append({"op": "update", "feature": feature, "route": route_id, "set": changed})
+            elif removed:
+                source = removed.pop(0)
+                changed = {field: value for field, value in route.items() if before[source].get(field) != value}
+                changes.append({"op": "move", "from": source, "feature": feature, "route": route_id,
+                                "index": index, "set": changed})
+            else:
+                changes.append({"op": "add", "feature": feature, "route": route_id, "index": index, "value": route})
+        changes.extend({"op": "remove", "feature": feature, "route": route_id} for feature in removed)
+
+    # Routes that kept their platform but not their place are not covered by the changes above
+    # Compared serialized, as a route that gained a field is equal as a dict but written in another key order
+    applied = apply_route_changes(copy.deepcopy(old), changes)
+    for feature_index, (feature, target) in enumerate(zip(applied["features"], new["features"])):
+        if json.dumps(feature["properties"].get("Routes")) != json.dumps(target["properties"].get("Routes")):
+            changes.append({"op": "routes", "feature": feature_index, "value": target["properties"]["Routes"]})
+    return changes
+
+
+def apply_route_changes(geojson_json, changes):
+    """Apply the output of route_changes in place: removals, then updates, then insertions, then whole platforms"""
+    features = [feature["properties"] for feature in geojson_json["features"]]
+
+    def find(feature, route_id):
+        routes = features[feature]["Routes"]
+        return next(i for i, route in enumerate(routes) if route["Id"] == route_id)
+
+    moved = {}
+    for change in changes:
+        if change["op"] in ("remove", "move"):
+            source = change["from"] if change["op"] == "move" else change["feature"]
+            route = features[source]["Routes"].pop(find(source, change["route"]))
+            moved[(change["feature"], change["route"])] = route
+    for change in changes:
+        if change["op"] == "update":
+            features[change["feature"]]["Routes"][find(change["feature"], change["route"])].update(change["set"])
+    for change in sorted((change for change in changes if change["op"] in ("add", "move")), key=lambda c: c["index"]):
+        if change["op"] == "add":
+            route = copy.deepcopy(change["value"])
+        else:
+            route = {**moved[(change["feature"], change["route"])], **change["set"]}
+        features[change["feature"]]["Routes"].insert(change["index"], route)
+    for change in changes:
+        if change["op"] == "routes":
+            features[change["feature"]]["Routes"] = copy.deepcopy(change["value"])
+    return geojson_json
+
+
+def delta_index(stand):
+    try:
+        with open(f'{DELTAS_DIR}/{stand}/index.json', 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {"format": DELTA_FORMAT, "version": DELTA_VERSION, "stand": stand, "deltas": []}
+
+
+def published_output(stand, fallback=None):
+    """
+    The last output of a stand published through the change feed, or fallback (the output being replaced) for a
+    stand without one yet, if that was a complete output rather than the Stops-less one of a lone geojson stage
+    """
+    try:
+        with open(f'{DELTAS_DIR}/{stand}/published.json', 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        pass
+    if fallback is not None and all("Stops" in route for feature in fallback["features"]
+                                    for route in feature["properties"].get("Routes", [])):
+        return fallback
+    return None
+
+
+def write_delta(stand, new, previous=None):
+    """
+    Record the change from the last published output of a stand to its new one as the next numbered delta in
+    DELTAS_DIR/<stand>/, listed with its base and target hashes in index.json, and publish the new output.
+    previous is the output being replaced, it starts the feed of a stand that has none. Returns the delta, None
+    if nothing changed. A delta replaces the whole output (`snapshot`) when it cannot be described route by route,
+    or its route changes do not reproduce the new output exactly.
+    """
+    old = published_output(stand, previous)
+    os.makedirs(f'{DELTAS_DIR}/{stand}', exist_ok=True)
+    if old is None:
+        write_json(f'{DELTAS_DIR}/{stand}/published.json', new, indent=None)
+        return None
+    base, target = geojson_hash(old), geojson_hash(new)
+    if base == target:
+        return None
+    index = delta_index(stand)
+    index["version"] = DELTA_VERSION
+    changes = route_changes(old, new)
+    if changes is not None and geojson_hash(apply_route_changes(copy.deepcopy(old), changes)) != target:
+        changes = None
+    delta = {
+        "format": DELTA_FORMAT,
+        "version": DELTA_VERSION,
+        "stand": stand,
+        "sequence": len(index["deltas"]) + 1,
+        "created": time.time(),
+        "base": base,
+        "target": target,
+    }
+    if changes is None:
+        delta["snapshot"] = new
+        summary = {"snapshot": 1}
+    else:
+        delta["changes"] = changes
+        summary = dict(collections.Counter(change["op"] for change in changes))
+        bays = sum(1 for change in changes if "BayReported" in change.get("set", {}))
+        stops = sum(1 for change in changes if "Stops" in change.get("set", {}))
+        if bays:
+            summary["bay"] = bays
+        if stops:
+            summary["stops"] = stops
+    path = f'{DELTAS_DIR}/{stand}/{delta["sequence"]:05d}.json'
+    write_json(path, delta, indent=None)
+    index["deltas"].append({"sequence": delta["sequence"], "created": delta["created"], "base": base,
+                            "target": target, "path": os.path.basename(path), "summary": summary})
+    write_json(f'{DELTAS_DIR}/{stand}/index.json', index)
+    write_json(f'{DELTAS_DIR}/{stand}/published.json', new, indent=None)
+    log.info('%s changed: %s, wrote %s', stand, ', '.join(f'{count} {op}' for op, count in summary.items()), path)
+    return delta
+
+
+def apply_delta(geojson_json, delta):
+    """
+    Apply a delta written by write_delta to the output it was computed from, returning the new output. Raises
+    ValueError if geojson_json is not the delta's base or the result is not its target. A snapshot applies to
+    any output, so a client that fell out of step can always catch up.
+    """
+    if delta.get("format") != DELTA_FORMAT or delta.get("version") != DELTA_VERSION:
+        raise ValueError(f'Not a {DELTA_FORMAT} v{DELTA_VERSION} delta')
+    if "snapshot" not in delta and geojson_hash(geojson_json) != delta["base"]:
+        raise ValueError(f'Delta {delta["sequence"]} of {delta["stand"]} does not apply to this output')
+    if "snapshot" in delta:
+        result = copy.deepcopy(delta["snapshot"])
+    else:
+        result = apply_route_changes(copy.deepcopy(geojson_json), delta["changes"])
+    if geojson_hash(result) != delta["target"]:
+        raise ValueError(f'Applying delta {delta["sequence"]} of {delta["stand"]} did not give its target')
+    return result
+
+
+def apply_deltas(geojson_json, deltas):
+    """Apply consecutive deltas, e.g. every delta in an index after the client's current version"""
+    for delta in deltas:
+        geojson_json = apply_delta(geojson_json, delta)
     return geojson_json
 
 
+def build_outputs(stop_ids, file, platforms_raw=None):
+    """
+    Run geo_json and add_routes_gtfs_geojson as one in-memory pipeline, so the output is only serialized once
+    """
+    geojson_json = geo_json(stop_ids, file, platforms_raw, write_output=False)
+    if not geojson_json:
+        return geojson_json
+    return add_routes_gtfs_geojson(stop_ids, file, geojson_json)
+
+
+# Citywide dataset configuration
+CITYWIDE_PATH = 'out/citywide.json'
+CITYWIDE_VERSION = 1
+CITYWIDE_GRID_DEGREES = 0.005  # Side of a spatial index cell, about 550m
+EARTH_RADIUS_METERS = 6371000
+
+
+def stand_outputs():
+    """Stand name -> path of every stand output in out/"""
+    outputs = {}
+    for name in sorted(os.listdir('out')):
+        if name.startswith('platforms-routes-') and name.endswith('.geojson'):
+            outputs[name[len('platforms-routes-'):-len('.geojson')]] = f'out/{name}'
+    return outputs
+
+
+def grid_cell(lat, lon):
+    return math.floor(lat / CITYWIDE_GRID_DEGREES), math.floor(lon / CITYWIDE_GRID_DEGREES)
+
+
+def distance_meters(lat1, lon1, lat2, lon2):
+    """Great-circle distance"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+def merge_stands(geojsons, sources):
+    """
+    Merge the outputs of every stand (stand -> geojson) into one citywide dataset with precomputed lookups:
+
+    - `platforms`: [stand, platform, lat, lon] rows, lat / lon are null for platforms that are not points
+    - `routes`: route id -> [name, destination, unique name, [[platform row, bay reported], ...]]
+    - `route_numbers`: route number -> route ids
+    - `stops`: stop name -> ids of the routes going through it
+    - `stands`: stand -> its platform rows
+    - `grid`: "lat_cell,lon_cell" -> platform rows in that CITYWIDE_GRID_DEGREES cell
+    - `sources`: the sources passed in, e.g. stand -> hash of its output
+    """
+    platforms = []
+    routes = {}
+    route_numbers = {}
+    stops = {}
+    stands = {}
+    grid = {}
+    for stand, geojson_json in geojsons.items():
+        stands[stand] = []
+        for feature in geojson_json["features"]:
+            row = len(platforms)
+            lat = lon = None
+            if feature["geometry"]["type"] == "Point":
+                lon, lat = feature["geometry"]["coordinates"][:2]
+                grid.setdefault('%d,%d' % grid_cell(lat, lon), []).append(row)
+            platforms.append([stand, str(feature["properties"]["Platform"]), lat, lon])
+            stands[stand].append(row)
+            for route in feature["properties"].get("Routes", []):
+                route_id = str(route["Id"])
+                if route_id not in routes:
+                    routes[route_id] = [route["Name"], route["Destination"], route["UniqueName"], []]
+                    route_numbers.setdefault(route["Name"], []).append(route_id)
+                routes[route_id][3].append([row, route["BayReported"]])
+                for stop in route.get("Stops", []):
+                    stops.setdefault(stop, {})[route_id] = None  # Ordered set, a route is seen at several stands
+    stops = {stop: list(route_ids) for stop, route_ids in stops.items()}
+    return {
+        'version': CITYWIDE_VERSION,
+        'grid_degrees': CITYWIDE_GRID_DEGREES,
+        'sources': sources,
+        'platforms': platforms,
+        'routes': routes,
+        'route_numbers': route_numbers,
+        'stops': stops,
+        'stands': stands,
+        'grid': grid,
+    }
+
+
+@metrics.stage('merge')
+def merge_outputs(outputs=None, path=CITYWIDE_PATH):
+    """Merge the given stand outputs (stand -> path), by default all of out/, into path"""
+    outputs = stand_outputs() if outputs is None else outputs
+    geojsons = {}
+    for stand, output in outputs.items():
+        with open(output, 'r') as file:
+            geojsons[stand] = json.load(file)
+    data = merge_stands(geojsons, {stand: file_hash(output) for stand, output in outputs.items()})
+    write_json(path, data, indent=None)
+    log.info('merged %d stands, %d platforms and %d routes into %s', len(outputs), len(data["platforms"]),
+             len(data["routes"]), path)
+    return path
+
+
+def merge_key(outputs=None):
+    outputs = stand_outputs() if outputs is None else outputs
+    return stage_key('merge', {stand: file_hash(output) for stand, output in outputs.items()})
+
+
+class CitywideIndex:
+    """
+    Lookups over the dataset written by merge_outputs. Route, route number, stop and stand lookups are
+    dictionary lookups, nearest platforms are found by searching the grid cells in rings around the point.
+    """
+
+    def __init__(self, data):
+        if data.get('version') != CITYWIDE_VERSION:
+            raise ValueError(f'Citywide dataset version {data.get("version")}, expected {CITYWIDE_VERSION}')
+        self.data = data
+        self.platforms = data['platforms']
+        self.routes = data['routes']
+        self.route_numbers = data['route_numbers']
+        self.base_route_numbers = {}  # Route number without its direction suffix -> route ids
+        for number, route_ids in self.route_numbers.items():
+            self.base_route_numbers.setdefault(number.rsplit(' ', 1)[0], []).extend(route_ids)
+        self.stops = data['stops']
+        self.stands = data['stands']
+        self.grid_degrees = data['grid_degrees']
+        self.grid = {tuple(map(int, cell.split(','))): rows for cell, rows in data['grid'].items()}
+        if self.grid:
+            self.grid_bounds = (min(cell[0] for cell in self.grid), max(cell[0] for cell in self.grid),
+                                min(cell[1] for cell in self.grid), max(cell[1] for cell in self.grid))
+
+    @classmethod
+    def load(cls, path=CITYWIDE_PATH):
+        with open(path, 'r') as file:
+            return cls(json.load(file))
+
+    def platform(self, row):
+        stand, platform, lat, lon = self.platforms[row]
+        return {'stand': stand, 'platform': platform, 'location': None if lat is None else [lat, lon]}
+
+    def route(self, route_id):
+        """A route by id with every (stand, platform, bay) it leaves from, None if it is unknown"""
+        route = self.routes.get(str(route_id))
+        if route is None:
+            return None
+        name, destination, unique_name, platforms = route
+        return {
+            'id': str(route_id), 'name': name, 'destination': destination, 'unique_name': unique_name,
+            'platforms': [{**self.platform(row), 'bay': bay} for row, bay in platforms],
+        }
+
+    def routes_by_number(self, route_number):
+        """Every route with this route number, with or without the direction suffix (e.g. "201" or "201 DOWN")"""
+        route_ids = self.route_numbers.get(route_number)
+        if route_ids is None:
+            route_ids = self.base_route_numbers.get(route_number, [])
+        return [self.route(route_id) for route_id in route_ids]
+
+    def stop_routes(self, stop_name):
+        """Ids of the routes going through a stop"""
+        return self.stops.get(stop_name, [])
+
+    def stand_platforms(self, stand):
+        """The platforms of a stand, None if it is unknown"""
+        rows = self.stands.get(stand)
+        return None if rows is None else [self.platform(row) for row in rows]
+
+    def nearest_platforms(self, lat, lon, count=1, max_distance=None):
+        """
+        Up to count platforms closest to (lat, lon), nearest first, as platform dicts with a `distance` in
+        meters. Only the cells that can hold a closer platform than the ones already found are visited. Raises
+        ValueError for a count below 1 or a point or distance that is not a finite number.
+        """
+        if count < 1:
+            raise ValueError(f'count must be at least 1, not {count}')
+        if not (math.isfinite(lat) and math.isfinite(lon)) or abs(lat) > 90 or abs(lon) > 180:
+            raise ValueError(f'{lat}, {lon} is not a valid point')
+        if max_distance is not None and not max_distance >= 0:
+            raise ValueError(f'max_distance must be a distance in meters, not {max_distance}')
+        if not self.grid:
+            return []
+        center_lat, center_lon = math.floor(lat / self.grid_degrees), math.floor(lon / self.grid_degrees)
+        min_lat, max_lat, min_lon, max_lon = self.grid_bounds
+        max_ring = max(center_lat - min_lat, max_lat - center_lat, center_lon - min_lon, max_lon - center_lon)
+        # A platform in ring r is at least r - 1 whole cells away along one axis
+        cell_meters = math.radians(self.grid_degrees) * EARTH_RADIUS_METERS * math.cos(math.radians(min(abs(lat) + 1, 90)))
+        found = []
+        for ring in range(max_ring + 1):
+            if len(found) >= count and found[count - 1][0] <= (ring - 1) * cell_meters:
+                break
+            if max_distance is not None and (ring - 1) * cell_meters > max_distance:
+                break
+            for cell_lat in range(center_lat - ring, center_lat + ring + 1):
+                step = 1 if abs(cell_lat - center_lat) == ring else 2 * ring
+                for cell_lon in range(center_lon - ring, center_lon + ring + 1, step or 1):
+                    for row in self.grid.get((cell_lat, cell_lon), ()):
+                        _, _, row_lat, row_lon = self.platforms[row]
+                        found.append((distance_meters(lat, lon, row_lat, row_lon), row))
+            found.sort()
+        if max_distance is not None:
+            found = [item for item in found if item[0] <= max_distance]
+        return [{**self.platform(row), 'distance': distance} for distance, row in found[:count]]
+
+
+# Query server configuration
+SERVE_HOST = os.environ.get('BMTC_SERVE_HOST', '127.0.0.1')
+SERVE_PORT = int(os.environ.get('BMTC_SERVE_PORT', 8000))
+SERVE_RELOAD_SECONDS = 2  # How often out/ is checked for changed outputs
+SERVE_GZIP_MIN_BYTES = 512  # Smaller responses are not worth compressing
+
+
+class ServedDataset:
+    """Every stand output in out/, parsed once, with the citywide index built over them in memory"""
+
+    def __init__(self, outputs=None):
+        outputs = stand_outputs() if outputs is None else outputs
+        self.stats = output_stats(outputs)
+        geojsons = {}
+        self.stands = {}  # Stand -> (etag, body, gzipped body) of its geojson
+        self.features = {}  # (stand, platform) -> features, a platform can have several with the same name
+        for stand, output in outputs.items():
+            with open(output, 'rb') as file:
+                content = file.read()
+            geojsons[stand] = geojson_json = json.loads(content)
+            body = json.dumps(geojson_json, separators=(',', ':')).encode()
+            self.stands[stand] = (f'"{hashlib.sha256(content).hexdigest()[:32]}"', body, gzip.compress(body))
+            for feature in geojson_json["features"]:
+                self.features.setdefault((stand, str(feature["properties"]["Platform"])), []).append(feature)
+        sources = {stand: etag.strip('"') for stand, (etag, _, _) in self.stands.items()}
+        self.index = CitywideIndex(merge_stands(geojsons, sources))
+        self.build_hash = stage_key('serve', sources)
+
+    def etag(self, target):
+        """ETag of a query response, it only changes when the outputs do"""
+        return f'"{hashlib.sha256(f"{self.build_hash}{target}".encode()).hexdigest()[:32]}"'
+
+
+def output_stats(outputs):
+    stats = {}
+    for stand, output in outputs.items():
+        stat = os.stat(output)
+        stats[stand] = (stat.st_size, stat.st_mtime_ns)
+    return stats
+
+
+class PlatformRequestHandler(BaseHTTPRequestHandler):
+    """
+    Read-only JSON endpoints over the server's ServedDataset:
+
+    - `/stands`: stand -> platform names
+    - `/stands/<stand>`: the stand's geojson
+    - `/stands/<stand>/<platform>`: the platform's features, as a FeatureCollection
+    - `/routes/<route_id>` and `/routes?number=<route_number>`: where routes leave from
+    - `/stops/<stop_name>`: the routes going through a stop
+    - `/nearby?lat=..&lon=..[&count=1][&max_distance=meters]`: the platforms closest to a point
+    """
+    protocol_version = 'HTTP/1.1'  # Keep-alive, every response has a Content-Length
+    disable_nagle_algorithm = True  # Headers and body are written separately, do not hold the body back
+
+    def do_GET(self):
+        dataset = self.server.dataset  # Keep one dataset for the whole request, a reload only swaps the reference
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if parts[0] == 'stands' and len(parts) == 2:
+                if parts[1] not in dataset.stands:
+                    raise KeyError(f'Unknown stand {parts[1]}')
+                self.respond(*dataset.stands[parts[1]])
+                return
+            self.respond_json(dataset, self.lookup(dataset.index, dataset, parts, query))
+        except KeyError as e:
+            self.respond_error(404, e.args[0])
+        except ValueError as e:
+            self.respond_error(400, str(e))
+
+    def lookup(self, index, dataset, parts, query):
+        if parts == ['stands']:
+            return {stand: [index.platforms[row][1] for row in rows] for stand, rows in index.stands.items()}
+        if parts[0] == 'stands' and len(parts) == 3:
+            features = dataset.features.get((parts[1], parts[2]))
+            if features is None:
+                raise KeyError(f'Unknown platform {parts[2]} at {parts[1]}')
+            return {"type": "FeatureCollection", "features": features}
+        if parts == ['routes'] and 'number' in query:
+            return index.routes_by_number(query['number'])
+        if parts[0] == 'routes' and len(parts) == 2:
+            route = index.route(parts[1])
+            if route is None:
+                raise KeyError(f'Unknown route {parts[1]}')
+            return route
+        if parts[0] == 'stops' and len(parts) == 2:
+            if parts[1] not in index.stops:
+                raise KeyError(f'Unknown stop {parts[1]}')
+            return [index.route(route_id) for route_id in index.stop_routes(parts[1])]
+        if parts == ['nearby']:
+            if 'lat' not in query or 'lon' not in query:
+                raise ValueError('nearby needs lat and lon')
+            max_distance = query.get('max_distance')
+            return index.nearest_platforms(float(query['lat']), float(query['lon']), int(query.get('count', 1)),
+                                           None if max_distance is None else float(max_distance))
+        raise KeyError(f'Unknown path {self.path}')
+
+    def respond_json(self, dataset, data):
+        etag = dataset.etag(self.path)
+        if self.headers.get('If-None-Match') in (etag, gzip_etag(etag)):
+            self.respond(etag, None, None)
+            return
+        body = json.dumps(data, separators=(',', ':')).encode()
+        self.respond(etag, body, gzip.compress(body) if len(body) >= SERVE_GZIP_MIN_BYTES else None)
+
+    def respond(self, etag, body, gzipped):
+        # The client's copy is current whichever representation of it it holds
+        cached = self.headers.get('If-None-Match')
+        if body is None or cached in (etag, gzip_etag(etag)):
+            self.send_response(304)
+            self.send_header('ETag', cached if cached in (etag, gzip_etag(etag)) else etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        encoding = None
+        if gzipped is not None and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body, etag, encoding = gzipped, gzip_etag(etag), 'gzip'
+        self.send_response(200)
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('%s %s', self.address_string(), format % args)
+
+    def log_error(self, format, *args):
+        log.warning('%s %s', self.address_string(), format % args)
+
+    def respond_error(self, status, message):
+        body = json.dumps({'error': message}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def gzip_etag(etag):
+    """The gzip representation of a response is a different entity, so it gets its own strong ETag"""
+    return etag[:-1] + '-gzip"'
+
+
+def reload_loop(server):
+    """Swap in a new dataset whenever a stand output is added, removed or rewritten"""
+    while True:
+        time.sleep(SERVE_RELOAD_SECONDS)
+        try:
+            outputs = stand_outputs()
+            if output_stats(outputs) == server.dataset.stats:
+                continue
+            server.dataset = ServedDataset(outputs)
+            log.info('reloaded %d stands', len(outputs))
+        except (OSError, ValueError, KeyError) as e:
+            log.error('could not reload the outputs, still serving the previous ones: %r', e)
+
+
+def serve(host=SERVE_HOST, port=SERVE_PORT):
+    server = ThreadingHTTPServer((host, port), PlatformRequestHandler)
+    server.daemon_threads = True
+    server.dataset = ServedDataset()
+    threading.Thread(target=reload_loop, args=(server,), daemon=True).start()
+    log.info('serving %d stands on http://%s:%d/', len(server.dataset.stands), host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def run_batch(manifest='stands.json', flags=None, stages=BUILD_STAGES, names=None):
+    return asyncio.run(run_batch_async(manifest, flags or {}, stages, names))
+
+
+async def run_batch_async(manifest, flags, stages=BUILD_STAGES, names=None):
+    """
+    Run the given stages for every stand of a manifest ({stand: {"stop_ids": [...], "nest_level": n}}), or
+    only for the stands in names, in one process. Stages whose inputs match the last successful build in
+    BUILD_MANIFEST_PATH are skipped unless flags has `force`. The stands that need fetching share one client,
+    which shares the concurrency budget fairly between them and sends a pair wanted by several stands only once.
+    """
+    with open(manifest, 'r') as p_m:
+        stands = json.loads(p_m.read())
+    if names:
+        unknown = [name for name in names if name not in stands]
+        if unknown:
+            raise ValueError(f'{", ".join(unknown)} not in {manifest}')
+        stands = {name: stands[name] for name in names}
+    build = BuildManifest.load()
+    force = bool(flags.get('force'))
+    failed = []
+
+    results = {}
+    if 'fetch' in stages:
+        with open('overrides.json', 'r') as p_m:
+            overrides_json = json.loads(p_m.read().replace('\n', ''))
+        keys = {name: fetch_key(name, stand["stop_ids"], stand.get("nest_level", 2), overrides_json, flags)
+                for name, stand in stands.items()}
+        fetching = [name for name in stands if force or not build.is_current(
+            name, 'fetch', keys[name], f'raw/platforms-{name}.json', FETCH_MAX_AGE_HOURS * 3600)]
+        log.info('fetching %d of %d stands from %s', len(fetching), len(stands), manifest)
+        if fetching:
+            init_cache_db()
+            cleanup_expired_cache()
+            load_gtfs_graph()
+            with metrics.stage('fetch'):
+                async with ApiClient() as client:
+                    with metrics.stage('route_list'):
+                        catalogue = await load_route_catalogue(client)
+                    fetched = await asyncio.gather(*(
+                        search_platforms(client, catalogue.by_id, load_overrides(stands[name]["stop_ids"], overrides_json),
+                                         stands[name]["stop_ids"], name, stands[name].get("nest_level", 2), flags)
+                        for name in fetching
+                    ), return_exceptions=True)
+            print_cache_stats()
+            close_cache_db()
+            for name, result in zip(fetching, fetched):
+                if isinstance(result, BaseException):
+                    log.error('%s failed: %r', name, result)
+                    failed.append(name)
+                    continue
+                results[name] = result
+                build.record(name, 'fetch', keys[name], f'raw/platforms-{name}.json')
+            build.save()
+
+    for name, stand in stands.items():
+        if name in failed:
+            continue
+        output = f'out/platforms-routes-{name}.geojson'
+        key = geojson_key(name, stand["stop_ids"])
+        geojson_current = not force and build.is_current(name, 'geojson', key, output)
+        if 'stops' in stages:
+            if not force and geojson_current and build.is_current(name, 'stops', stops_key(key), output):
+                log.info('%s is up to date', name)
+                continue
+            if 'geojson' in stages or not geojson_current:
+                build_outputs(stand["stop_ids"], name, results.get(name))
+            else:
+                add_routes_gtfs_geojson(stand["stop_ids"], name)
+            build.record(name, 'geojson', key, output)
+            build.record(name, 'stops', stops_key(key), output)
+        elif 'geojson' in stages:
+            if geojson_current:
+                log.info('%s is up to date', name)
+                continue
+            geo_json(stand["stop_ids"], name, results.get(name))
+            build.record(name, 'geojson', key, output)
+            build.forget(name, 'stops')
+        else:
+            continue  # Only fetching, which is logged above
+        build.save()
+        log.info('completed %s', name)
+
+    if 'merge' in stages:
+        # Merges every output in out/, not only the stands of this run
+        key = merge_key()
+        if not force and build.is_current(CITYWIDE, 'merge', key, CITYWIDE_PATH):
+            log.info('%s is up to date', CITYWIDE_PATH)
+        else:
+            merge_outputs()
+            build.record(CITYWIDE, 'merge', key, CITYWIDE_PATH)
+            build.save()
+    return failed
+
+
+def main(argv):
+    """Run the command line (without the program name), returns the exit status"""
+    if argv[0:1] == ['compile']:
+        # Compile the gtfs snapshot once up front so concurrent stand runs only have to map it
+        print(compile_gtfs_snapshot(argv[1] if len(argv) > 1 else None))
+        return 0
+    if argv[0:1] == ['serve']:
+        args, flags = split_flags(argv[1:])
+        serve(flags.get('host', SERVE_HOST), int(args[0]) if args else SERVE_PORT)
+        return 0
+    if argv[0:1] and argv[0] in ('fetch', 'geojson', 'stops', 'merge', 'all', 'batch'):
+        # <stage> [stands.json] [stand...] [--force] [--coverage] [--resume], batch is the old name of all
+        args, flags = split_flags(argv[1:])
+        manifest = args.pop(0) if args and args[0].endswith('.json') else 'stands.json'
+        stages = BUILD_STAGES if argv[0] in ('all', 'batch') else (argv[0],)
+        failed = run_batch(manifest, flags, stages, args)
+        return 1 if failed else 0
+    stop_ids, file, nest_level, flags = parse_stand_args(argv)
+    schedule_times = save_platforms(stop_ids, file, nest_level, flags)
+    build_outputs(stop_ids, file, schedule_times)
+    log.info('completed %s', file)
+    return 0
+
+
 if __name__ == '__main__':
-    print(sys.argv)
-    save_platforms()
-    geo_json()
-    add_routes_gtfs_geojson()
-    print(f"Completed {sys.argv[-2]}")
+    logging.basicConfig(level=os.environ.get('BMTC_LOG_LEVEL', 'INFO').upper(), stream=sys.stdout,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    log.info('running %s', ' '.join(sys.argv))
+    # --profile[=path] runs everything under cProfile, --metrics=path moves the run summary
+    _, main_flags = split_flags(sys.argv[1:])
+    profiler = cProfile.Profile() if main_flags.get('profile') else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        status = main(sys.argv[1:])
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profile_path = PROFILE_PATH if main_flags['profile'] is True else main_flags['profile']
+            profiler.dump_stats(profile_path)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+            log.info('wrote profile to %s', profile_path)
+        if sys.argv[1:2] not in (['compile'], ['serve']):
+            metrics.write(main_flags['metrics'] if isinstance(main_flags.get('metrics'), str) else METRICS_PATH)
+    sys.exit(status)
@@ -0,0 +1,43 @@
+import copy
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import platforms
+
+
+def stand_output(*routes):
+    return {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [77.57, 12.97]},
+         "properties": {"Platform": "1", "Routes": list(routes)}}]}
+
+
+def test_delta_round_trip_when_routes_gain_a_field(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    old = stand_output({"Id": 1, "Stops": []}, {"Id": 2, "Stops": ["A"]})
+    new = stand_output({"Id": 1, "Match": "reported", "Stops": []}, {"Id": 2, "Match": "alias", "Stops": ["B"]})
+
+    changes = platforms.route_changes(old, new)
+    applied = platforms.apply_route_changes(copy.deepcopy(old), changes)
+    assert platforms.geojson_hash(applied) == platforms.geojson_hash(new)
+
+    platforms.write_delta('stand', old)
+    delta = platforms.write_delta('stand', new)
+    assert platforms.geojson_hash(platforms.apply_delta(old, delta)) == platforms.geojson_hash(new)
+
+
+def test_delta_keys_changes_by_feature_when_platform_names_repeat(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    old = stand_output({"Id": 1, "BayReported": "1", "Stops": []})
+    old["features"].append(copy.deepcopy(old["features"][0]))
+    old["features"][1]["geometry"]["coordinates"] = [77.58, 12.97]
+    new = copy.deepcopy(old)
+    new["features"][0]["properties"]["Routes"][0]["BayReported"] = "2"
+    new["features"][1]["properties"]["Routes"][0]["BayReported"] = "2"
+
+    platforms.write_delta('stand', old)
+    delta = platforms.write_delta('stand', new)
+    assert "snapshot" not in delta
+    assert [(change["op"], change["feature"]) for change in delta["changes"]] == [("update", 0), ("update", 1)]
+    assert platforms.geojson_hash(platforms.apply_delta(old, delta)) == platforms.geojson_hash(new)
@@ -0,0 +1,109 @@
+import csv
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import platforms
+
+STOPS = [
+    ('S1', 'Stand 1', 12.97, 77.57),
+    ('S2', 'Stand 2', 12.971, 77.571),
+    ('A', 'Alpha', 12.98, 77.58),
+    ('A', 'Alpha', 12.98, 77.58),  # Repeated stop_id
+    ('B', 'Bravo', 12.99, 77.59),
+    ('C', 'Charlie', 13.0, 77.6),
+    ('D', 'Delta', 13.01, 77.61),
+]
+TRIPS = [('R1', 'T1'), ('R1', 'T2'), ('R2', 'T3'), ('R2', 'T3'), ('R3', 'T4')]  # T3 is repeated
+STOP_TIMES = [
+    ('T1', 'S1', 1), ('T1', 'A', 2), ('T1', 'B', 3), ('T1', 'C', 4),
+    ('T2', 'B', 3), ('T2', 'S1', 1), ('T2', 'D', 4), ('T2', 'A', 2),  # Out of stop_sequence order
+    ('T3', 'C', 10), ('T3', 'S2', 2), ('T3', 'A', 5), ('T3', 'S1', 7), ('T3', 'D', 12),
+    ('T4', 'A', 1), ('T4', 'B', 2), ('T4', 'C', 3),
+]
+
+
+def write_feed(folder):
+    for name, header, rows in (('stops.txt', ('stop_id', 'stop_name', 'stop_lat', 'stop_lon'), STOPS),
+                               ('trips.txt', ('route_id', 'trip_id'), TRIPS),
+                               ('stop_times.txt', ('trip_id', 'stop_id', 'stop_sequence'), STOP_TIMES)):
+        with open(os.path.join(folder, name), 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+
+def read_csv(folder, name):
+    with open(os.path.join(folder, name), newline='') as file:
+        return list(csv.DictReader(file))
+
+
+def baseline_next_stops(folder, stop_ids, nest_level):
+    """get_next_stops as it read the csv files before the graph"""
+    stop_times = read_csv(folder, 'stop_times.txt')
+    next_stops_total = {stop_id: [] for stop_id in stop_ids}
+    stop_times_by_trip = {}
+    for st in stop_times:
+        stop_times_by_trip.setdefault(st['trip_id'], []).append(st)
+    for trip_id in stop_times_by_trip:
+        stop_times_by_trip[trip_id].sort(key=lambda x: int(x['stop_sequence']))
+    for stop_id in stop_ids:
+        for st in stop_times:
+            if st['stop_id'] != stop_id:
+                continue
+            trip_stop_times = stop_times_by_trip[st['trip_id']]
+            current_index = next(i for i, x in enumerate(trip_stop_times) if x['stop_id'] == stop_id)
+            for offset in range(nest_level):
+                idx = current_index + offset
+                if idx >= len(trip_stop_times) - 1:
+                    break
+                curr = trip_stop_times[idx]['stop_id']
+                nxt = trip_stop_times[idx + 1]['stop_id']
+                next_stops_total.setdefault(curr, [])
+                if nxt not in next_stops_total[curr]:
+                    next_stops_total[curr].append(nxt)
+    return next_stops_total
+
+
+def baseline_route_stop_names(folder, route_id, stop_ids):
+    """The Stops of a route as add_routes_gtfs_geojson built them from the csv files"""
+    stops = {stop['stop_id']: stop['stop_name'] for stop in read_csv(folder, 'stops.txt')}
+    trips = [trip for trip in read_csv(folder, 'trips.txt') if trip['route_id'] == route_id]
+    if not trips:
+        return []
+    loop_stops = sorted((st for st in read_csv(folder, 'stop_times.txt') if st['trip_id'] == trips[0]['trip_id']),
+                        key=lambda st: int(st['stop_sequence']))
+    loop_stops = loop_stops[next((i for i, st in enumerate(loop_stops) if st['stop_id'] in stop_ids), None):]
+    return [stops[st['stop_id']] for st in loop_stops]
+
+
+@pytest.fixture(params=['csv', 'snapshot'])
+def graph(request, tmp_path):
+    write_feed(tmp_path)
+    graph = platforms.GtfsGraph.from_folder(tmp_path)
+    if request.param == 'snapshot':
+        graph.save(tmp_path / 'gtfs.snapshot')
+        graph = platforms.GtfsGraph.load(tmp_path / 'gtfs.snapshot')
+    return graph
+
+
+@pytest.mark.parametrize('stop_ids', [['S1'], ['S1', 'S2'], ['A']])
+@pytest.mark.parametrize('nest_level', [1, 2, 5])
+def test_next_stops_match_the_csv_search(graph, tmp_path, stop_ids, nest_level):
+    assert graph.next_stops(stop_ids, nest_level) == baseline_next_stops(tmp_path, stop_ids, nest_level)
+
+
+@pytest.mark.parametrize('stop_ids', [['S1'], ['S1', 'S2'], ['D']])
+def test_route_stop_names_match_the_csv_lookup(graph, tmp_path, stop_ids):
+    starts = graph.pattern_starts(stop_ids)
+    for route_id in ('R1', 'R2', 'R3', 'R4'):
+        assert graph.route_stop_names(route_id, starts) == baseline_route_stop_names(tmp_path, route_id, stop_ids)
+
+
+def test_stop_location(graph, tmp_path):
+    for stop in read_csv(tmp_path, 'stops.txt'):
+        assert graph.stop_location(stop['stop_id']) == [float(stop['stop_lat']), float(stop['stop_lon'])]
+    assert graph.stop_location('X') is None
@@ -0,0 +1,78 @@
+import asyncio
+import collections
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import platforms
+
+
+def random_graph(rng, stops=40, edges=3):
+    """Stop -> next stops, with cycles and several paths of different lengths to the same stop"""
+    return {str(stop): sorted({str(rng.randrange(stops)) for _ in range(rng.randint(0, edges))})
+            for stop in range(stops)}
+
+
+def level_bfs(origins, next_stops, nest_level, failed):
+    """The pairs the level by level search requests: each origin in turn, one level at a time"""
+    requested = set()
+    for origin in origins:
+        frontier = [origin]
+        for level in range(nest_level):
+            following = []
+            for stop in frontier:
+                for next_stop in next_stops.get(stop, []):
+                    if (origin, next_stop) in requested:
+                        continue
+                    requested.add((origin, next_stop))
+                    if (origin, next_stop) in failed:
+                        following.append(next_stop)
+            frontier = following
+    return requested
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_search_requests_the_level_bfs_pairs_once(seed):
+    rng = random.Random(seed)
+    next_stops = random_graph(rng)
+    origins = ['0', '1', '2']
+    failed = {(origin, stop) for origin in origins for stop in next_stops if rng.random() < 0.7}
+    requests = collections.Counter()
+
+    async def send_request(origin, stop):
+        requests[(origin, stop)] += 1
+        await asyncio.sleep(rng.choice((0, 0, 0.001, 0.005)))  # Answers come back out of order
+        return origin, stop, {}, (origin, stop) in failed
+
+    search = platforms.PlatformSearch(origins, next_stops, 5, send_request, lambda *result: None)
+    asyncio.run(search.run(workers=8))
+
+    assert set(requests) == level_bfs(origins, next_stops, 5, failed)
+    assert all(count == 1 for count in requests.values())
+    assert search.requested == len(requests)
+
+
+@pytest.mark.parametrize('latency', [
+    {('O', 'X'): 0.02},  # The short path arrives after the pair was answered through the long one
+    {('O', 'X'): 0.02, ('O', 'P'): 0.05},  # ... or while its request is still in flight
+])
+def test_search_expands_a_pair_from_its_shallowest_level(latency):
+    # P is 2 hops from O through X, 3 through A and B. Only the short path leaves room to reach R
+    next_stops = {'O': ['A', 'X'], 'A': ['B'], 'B': ['P'], 'X': ['P'], 'P': ['Q'], 'Q': ['R']}
+    requests = collections.Counter()
+
+    async def send_request(origin, stop):
+        requests[(origin, stop)] += 1
+        await asyncio.sleep(latency.get((origin, stop), 0))
+        return origin, stop, {}, True
+
+    search = platforms.PlatformSearch(['O'], next_stops, 4, send_request, lambda *result: None)
+    asyncio.run(search.run(workers=4))
+
+    assert set(requests) == level_bfs(['O'], next_stops, 4, {('O', stop) for stop in 'ABXPQR'})
+    assert ('O', 'R') in requests
+    assert all(count == 1 for count in requests.values())